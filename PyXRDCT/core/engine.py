@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#    Project: PyXRDCT
+#             https://github.com/poautran/PyXRDCT
+#
+#    Copyright (C) 2022-2023 European Synchrotron Radiation Facility, Grenoble,
+#             France
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NON INFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import scipy.sparse
+
+ENGINE_ARRAYS = ('data', 'indices', 'indptr', 'radial', 'normalization', 'denominator', 'dark')
+
+
+def engine_key(config, shape, mask=None, dark=None, flat=None):
+    """
+    Hashes everything the integration matrix and correction arrays depend on.
+    """
+    keys = ['dist', 'poni1', 'poni2', 'rot1', 'rot2', 'rot3', 'wavelength', 'detector_config', 'nbpt_rad', 'unit',
+            'do_radial_range', 'radial_range_min', 'radial_range_max', 'do_azimuthal_range', 'azimuth_range_min',
+            'azimuth_range_max', 'polarization_factor']
+    geometry = {key: config.get(key) for key in keys}
+    geometry['shape'] = [int(i) for i in shape]
+    h = hashlib.sha1(json.dumps(geometry, sort_keys=True, default=str).encode())
+    for array in (mask, dark, flat):
+        h.update(b'-' if array is None else np.ascontiguousarray(array).tobytes())
+    return h.hexdigest()
+
+
+class IntegrationEngine:
+    """
+    Sparse-matrix 1D integrator built once per geometry.
+
+    The pixel splitting of pyFAI is stored as a CSR matrix of shape (nbpt_rad, npixels) while dark, flat,
+    solid angle and polarization are folded into per-pixel arrays, so a whole block of frames is integrated
+    with a single sparse-matrix x dense-block product.
+    """
+
+    def __init__(self, matrix, radial, normalization, denominator, dark=None):
+        self.matrix = matrix
+        self.radial = radial
+        self.normalization = normalization
+        self.denominator = denominator
+        self.dark = dark
+
+    @classmethod
+    def build(cls, ai, shape, nbpt_rad, unit, mask=None, dark=None, flat=None, radial_range=None,
+              azimuth_range=None, polarization_factor=None):
+        """
+        Computes the integration matrix and correction arrays from a pyFAI AzimuthalIntegrator.
+        """
+        import pyFAI.units
+        shape = tuple(shape)
+        unit = pyFAI.units.to_unit(unit)
+        if ai.detector.mask is not None:
+            mask = ai.detector.mask if mask is None else np.logical_or(mask, ai.detector.mask)
+        if azimuth_range is not None:
+            azimuth_range = tuple(np.deg2rad(azimuth_range))
+        engine = ai.setup_sparse_integrator(shape, nbpt_rad, mask=mask, pos0_range=radial_range,
+                                            pos1_range=azimuth_range, unit=unit, split='full', algo='CSR',
+                                            scale=True)
+        data, indices, indptr = engine.lut
+        matrix = scipy.sparse.csr_matrix((data, indices, indptr), shape=(nbpt_rad, int(np.prod(shape))))
+        normalization = ai.solidAngleArray(shape, absolute=False).astype(np.float32)
+        if polarization_factor is not None:
+            normalization *= ai.polarization(shape, polarization_factor)
+        if flat is not None:
+            normalization *= flat
+        normalization = normalization.ravel()
+        if dark is not None:
+            dark = np.ascontiguousarray(dark, dtype=np.float32).ravel()
+        return cls(matrix, np.asarray(engine.bin_centers) * unit.scale, normalization, matrix.dot(normalization),
+                   dark)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Memory-maps a saved engine read-only, so that all workers share the same pages.
+        """
+        arrays = {}
+        for name in ENGINE_ARRAYS:
+            if os.path.exists(os.path.join(path, name + '.npy')):
+                arrays[name] = np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        matrix = scipy.sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                                         shape=(len(arrays['denominator']), len(arrays['normalization'])),
+                                         copy=False)
+        return cls(matrix, arrays['radial'], arrays['normalization'], arrays['denominator'], arrays.get('dark'))
+
+    def save(self, path):
+        """
+        Saves the engine as a directory of .npy files. The directory appears atomically.
+        """
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmpPath = tempfile.mkdtemp(prefix='.tmp_', dir=os.path.dirname(path))
+        arrays = {'data': self.matrix.data, 'indices': self.matrix.indices, 'indptr': self.matrix.indptr,
+                  'radial': self.radial, 'normalization': self.normalization, 'denominator': self.denominator,
+                  'dark': self.dark}
+        for name, array in arrays.items():
+            if array is not None:
+                np.save(os.path.join(tmpPath, name + '.npy'), array)
+        try:
+            os.rename(tmpPath, path)
+        except OSError:
+            shutil.rmtree(tmpPath)
+
+    def integrate(self, frames):
+        """
+        Integrates a (frames, rows, columns) block and returns a (frames, nbpt_rad) float32 array.
+        """
+        block = np.asarray(frames, dtype=np.float32).reshape(len(frames), -1)
+        if self.dark is not None:
+            block = block - self.dark
+        signal = self.matrix.dot(block.T).T
+        valid = self.denominator > 0
+        result = np.zeros(signal.shape, dtype=np.float32)
+        result[:, valid] = signal[:, valid] / self.denominator[valid]
+        return result
+
+    def integrate_sparse(self, index, frame, intensity, nframes, dark=True):
+        """
+        Integrates sparse frames, given as the flat pixel index, frame number and intensity of their stored pixels,
+        into a (nframes, nbpt_rad) float32 array. Only the matrix columns of the stored pixels are used, so the cost
+        scales with their number instead of the detector size.
+        Pixels that are not stored are taken as background and contribute zero: with raw stored intensities (dark
+        set) the dark is subtracted from the stored pixels and unstored ones count as dark level, while intensities
+        already background subtracted (dark=False) are integrated as they are.
+        """
+        if not hasattr(self, 'columns'):
+            self.columns = self.matrix.tocsc()
+        index = np.asarray(index, dtype=np.int64)
+        values = np.asarray(intensity, dtype=np.float32)
+        if dark and self.dark is not None:
+            values = values - self.dark[index]
+        pixels = scipy.sparse.csr_matrix((values, np.asarray(frame, dtype=np.int64), np.arange(len(index) + 1)),
+                                         shape=(len(index), nframes))
+        signal = (self.columns[:, index] @ pixels).toarray().T
+        valid = self.denominator > 0
+        result = np.zeros(signal.shape, dtype=np.float32)
+        result[:, valid] = signal[:, valid] / self.denominator[valid]
+        return result
+
+
+def cached_engine(cachePath, config, ai, shape, mask=None, dark=None, flat=None, radial_range=None,
+                  azimuth_range=None):
+    """
+    Returns the path of the engine matching the geometry in cachePath, building and saving it on first use.
+    """
+    path = os.path.join(cachePath, engine_key(config, shape, mask, dark, flat))
+    if os.path.exists(path):
+        print('[INFO] Integration engine found in %s' % path)
+    else:
+        IntegrationEngine.build(ai, shape, config['nbpt_rad'], config['unit'], mask=mask, dark=dark, flat=flat,
+                                radial_range=radial_range, azimuth_range=azimuth_range,
+                                polarization_factor=float(config['polarization_factor'])).save(path)
+        print('[INFO] Integration engine saved in %s' % path)
+    return path
+
+
+def cached_radial_map(cachePath, config, shape):
+    """
+    Returns the radial position of every pixel centre of a detector of the given shape, in the unit of the pyFAI
+    config, as a float32 (rows, columns) array saved in cachePath on first use and memory-mapped afterwards.
+    """
+    path = os.path.join(cachePath, engine_key(config, shape) + '_radial.npy')
+    if not os.path.exists(path):
+        import pyFAI.units
+        from PyXRDCT.core.integrate import setup_integrator
+        ai = setup_integrator(config, corrections=False)[0]
+        radial = ai.array_from_unit(tuple(shape), 'center', pyFAI.units.to_unit(config['unit']), scale=True)
+        os.makedirs(cachePath, exist_ok=True)
+        fd, tmpPath = tempfile.mkstemp(prefix='.tmp_', suffix='.npy', dir=cachePath)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, np.ascontiguousarray(radial, dtype=np.float32))
+        os.replace(tmpPath, path)
+        print('[INFO] Radial map saved in %s' % path)
+    return np.load(path, mmap_mode='r')
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#    Project: PyXRDCT
+#             https://github.com/poautran/PyXRDCT
+#
+#    Copyright (C) 2022-2023 European Synchrotron Radiation Facility, Grenoble,
+#             France
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NON INFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+
+import numba
+import numpy as np
+import scipy.fft
+
+# the library forks worker pools (integration, segmentation, iradon) after the backprojection kernels may have run,
+# and processes forked after a TBB parallel region hang the interpreter at exit: numba is made to prefer the fork-safe
+# OpenMP and workqueue threading layers unless NUMBA_THREADING_LAYER is set
+if 'NUMBA_THREADING_LAYER' not in os.environ:
+    numba.config.THREADING_LAYER_PRIORITY = ['omp', 'workqueue', 'tbb']
+
+
+def ramp_filter(size):
+    """
+    Ramp filter in Fourier space, computed from its spatial form as skimage.transform.iradon does.
+    """
+    n = np.concatenate((np.arange(1, size / 2 + 1, 2, dtype=int), np.arange(size / 2 - 1, 0, -2, dtype=int)))
+    f = np.zeros(size)
+    f[0] = 0.25
+    f[1::2] = -1 / (np.pi * n) ** 2
+    return 2 * np.real(scipy.fft.fft(f))
+
+
+def filter_sinograms(sinograms, circle=True):
+    """
+    Ramp-filters a (detector, angles, channels) block of sinograms with one batched FFT along the detector axis.
+    Returns the filtered block as (angles, detector, channels) float32, contiguous along channels.
+    """
+    ndet = sinograms.shape[0]
+    size = int(np.ceil(np.sqrt(2) * ndet)) if circle else ndet
+    # padding the detector axis to the circle diagonal only shifts the circular convolution
+    offset = size // 2 - ndet // 2
+    paddedSize = max(64, int(2 ** np.ceil(np.log2(2 * size))))
+    projection = scipy.fft.rfft(np.asarray(sinograms, dtype=np.float32), n=paddedSize, axis=0, workers=-1)
+    projection *= ramp_filter(paddedSize)[:paddedSize // 2 + 1, None, None].astype(np.float32)
+    filtered = scipy.fft.irfft(projection, n=paddedSize, axis=0, workers=-1)
+    return filtered.transpose(1, 0, 2)[:, (np.arange(size) - offset) % paddedSize]
+
+
+@numba.njit(parallel=True, cache=True)
+def backproject(filtered, cosTheta, sinTheta, outputSize, circle, out):
+    """
+    Backprojects (angles, detector, channels) filtered sinograms into out (outputSize, outputSize, channels).
+    The interpolation position and weight of each pixel and angle are shared by all channels.
+    """
+    nangles, ndet, nchannels = filtered.shape
+    radius = outputSize // 2
+    center = ndet // 2
+    for i in numba.prange(outputSize):
+        xpr = i - radius
+        pixel = np.zeros(nchannels, dtype=np.float32)
+        for j in range(outputSize):
+            ypr = j - radius
+            pixel[:] = 0
+            if not (circle and xpr * xpr + ypr * ypr > radius * radius):
+                for a in range(nangles):
+                    position = ypr * cosTheta[a] - xpr * sinTheta[a] + center
+                    if position < 0 or position > ndet - 1:
+                        continue
+                    k = int(position)
+                    f0 = filtered[a, k]
+                    if k == ndet - 1:
+                        for c in range(nchannels):
+                            pixel[c] += f0[c]
+                        continue
+                    f1 = filtered[a, k + 1]
+                    w = np.float32(position - k)
+                    w0 = np.float32(1) - w
+                    for c in range(nchannels):
+                        pixel[c] += w0 * f0[c] + w * f1[c]
+            out[i, j, :] = pixel
+    return out
+
+
+@numba.njit(parallel=True, cache=True)
+def backproject_row(profile, row, cosTheta, sinTheta, outputSize, circle, out):
+    """
+    Adds to out (outputSize, outputSize, channels) the backprojection of the separable filtered sinograms
+    profile (detector) x row (angles, channels): the interpolation weight of the profile at each pixel and angle
+    multiplies the channels of that angle.
+    """
+    nangles, nchannels = row.shape
+    ndet = profile.shape[0]
+    radius = outputSize // 2
+    center = ndet // 2
+    for i in numba.prange(outputSize):
+        xpr = i - radius
+        for j in range(outputSize):
+            ypr = j - radius
+            if circle and xpr * xpr + ypr * ypr > radius * radius:
+                continue
+            for a in range(nangles):
+                position = ypr * cosTheta[a] - xpr * sinTheta[a] + center
+                if position < 0 or position > ndet - 1:
+                    continue
+                k = int(position)
+                if k == ndet - 1:
+                    weight = profile[k]
+                else:
+                    w = np.float32(position - k)
+                    weight = (np.float32(1) - w) * profile[k] + w * profile[k + 1]
+                for c in range(nchannels):
+                    out[i, j, c] += weight * row[a, c]
+    return out
+
+
+def fbp_row(profile, row, theta, out, circle=True):
+    """
+    Adds to out (output_size, output_size, channels) the filtered backprojection of the sinograms
+    profile (detector) x row (angles, channels), such as one scan row of a sinogram block spread along the detector
+    by the axis shift. Only the profile is filtered, and the cost is one backprojection of row without building the
+    (detector, angles, channels) block.
+    """
+    theta = np.deg2rad(np.asarray(theta, dtype=np.float64))
+    filtered = np.ascontiguousarray(filter_sinograms(np.asarray(profile)[:, None, None], circle)[0, :, 0])
+    row = np.ascontiguousarray(row, dtype=np.float32) * np.float32(np.pi / (2 * len(theta)))
+    backproject_row(filtered, row, np.cos(theta), np.sin(theta), out.shape[0], circle, out)
+    return out
+
+
+def fbp(sinograms, theta, output_size=None, circle=True):
+    """
+    Filtered backprojection of a (detector, angles) sinogram or a (detector, angles, channels) block, matching
+    skimage.transform.iradon with the ramp filter and linear interpolation. theta is in degrees.
+    Returns a (output_size, output_size) image or a (channels, output_size, output_size) stack.
+    """
+    sinograms = np.asarray(sinograms)
+    single = sinograms.ndim == 2
+    if single:
+        sinograms = sinograms[:, :, None]
+    if output_size is None:
+        output_size = sinograms.shape[0] if circle else int(np.floor(np.sqrt(sinograms.shape[0] ** 2 / 2.0)))
+    theta = np.deg2rad(np.asarray(theta, dtype=np.float64))
+    filtered = filter_sinograms(sinograms, circle)
+    out = np.empty((output_size, output_size, sinograms.shape[2]), dtype=np.float32)
+    backproject(filtered, np.cos(theta), np.sin(theta), output_size, circle, out)
+    out *= np.pi / (2 * len(theta))
+    if single:
+        return out[:, :, 0]
+    return np.ascontiguousarray(out.transpose(2, 0, 1))
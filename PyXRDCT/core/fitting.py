@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#    Project: PyXRDCT
+#             https://github.com/poautran/PyXRDCT
+#
+#    Copyright (C) 2022-2023 European Synchrotron Radiation Facility, Grenoble,
+#             France
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NON INFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import concurrent.futures
+import os
+
+import h5py
+import numpy as np
+
+LN2 = 4 * np.log(2)
+PARAMETERS = {'gaussian': ('area', 'center', 'fwhm', 'background', 'slope'),
+              'pseudo-voigt': ('area', 'center', 'fwhm', 'background', 'slope', 'eta')}
+
+
+def profile_jacobian(x, params, profile):
+    """
+    Model values (voxels, points) and Jacobian (voxels, points, parameters) of the area normalised peak on a linear
+    background, for params (voxels, parameters) and x (points) centred on the fit window.
+    """
+    area, center, fwhm = params[:, 0, None], params[:, 1, None], params[:, 2, None]
+    u = (x - center) / fwhm
+    gauss = np.sqrt(LN2 / np.pi) / fwhm * np.exp(-LN2 * u ** 2)
+    jacobian = np.empty(params.shape[:1] + x.shape + params.shape[1:])
+    jacobian[:, :, 3] = 1
+    jacobian[:, :, 4] = x
+    if profile == 'gaussian':
+        peak = gauss
+        jacobian[:, :, 1] = area * gauss * 2 * LN2 * u / fwhm
+        jacobian[:, :, 2] = area * gauss * (2 * LN2 * u ** 2 - 1) / fwhm
+    else:
+        eta = params[:, 5, None]
+        lorentz = 2 / (np.pi * fwhm * (1 + 4 * u ** 2))
+        peak = eta * lorentz + (1 - eta) * gauss
+        jacobian[:, :, 1] = area * (eta * lorentz * 8 * u / (1 + 4 * u ** 2) +
+                                    (1 - eta) * gauss * 2 * LN2 * u) / fwhm
+        jacobian[:, :, 2] = area * (eta * lorentz * (8 * u ** 2 / (1 + 4 * u ** 2) - 1) +
+                                    (1 - eta) * gauss * (2 * LN2 * u ** 2 - 1)) / fwhm
+        jacobian[:, :, 5] = area * (lorentz - gauss)
+    jacobian[:, :, 0] = peak
+    return area * peak + params[:, 3, None] + params[:, 4, None] * x, jacobian
+
+
+def initial_guess(x, patterns, profile):
+    """
+    Background through the means of both window edges, peak at the maximum above it and width from area / height.
+    Returns the (voxels, parameters) guess and the voxels with a positive peak.
+    """
+    edge = max(1, len(x) // 10)
+    left, right = patterns[:, :edge].mean(axis=1), patterns[:, -edge:].mean(axis=1)
+    slope = (right - left) / (x[-edge:].mean() - x[:edge].mean())
+    background = left - slope * x[:edge].mean()
+    signal = patterns - background[:, None] - slope[:, None] * x
+    top = signal.argmax(axis=1)
+    height = signal[np.arange(len(top)), top]
+    step = abs(x[1] - x[0])
+    area = np.clip(signal, 0, None).sum(axis=1) * step
+    params = np.empty((len(patterns), len(PARAMETERS[profile])))
+    params[:, 0] = area
+    params[:, 1] = x[top]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        params[:, 2] = np.clip(area / (1.064 * height), step, x[-1] - x[0])
+    params[:, 3] = background
+    params[:, 4] = slope
+    if profile == 'pseudo-voigt':
+        params[:, 5] = 0.5
+    return params, height > 0
+
+
+def levenberg_marquardt(x, patterns, profile='gaussian', iterations=50, tol=1e-6):
+    """
+    Fits patterns (voxels, points) sampled at x with Levenberg-Marquardt, all voxels at once. Each voxel keeps its
+    own damping and leaves the active set when a step improves its cost by less than tol relatively.
+    Returns the (voxels, parameters) fit, NaN for voxels without a peak above background, and the reduced chi2.
+    """
+    patterns = np.asarray(patterns, dtype=np.float64)
+    x = np.asarray(x, dtype=np.float64)
+    middle = 0.5 * (x[0] + x[-1])
+    x = x - middle
+    params, valid = initial_guess(x, patterns, profile)
+    cost = np.full(len(patterns), np.nan)
+    active = np.nonzero(valid)[0]
+    model = profile_jacobian(x, params[active], profile)[0]
+    cost[active] = np.sum((model - patterns[active]) ** 2, axis=1)
+    damping = np.full(len(patterns), 1e-3)
+    step = abs(x[1] - x[0])
+    for i in range(iterations):
+        if len(active) == 0:
+            break
+        model, jacobian = profile_jacobian(x, params[active], profile)
+        residuals = model - patterns[active]
+        normal = np.einsum('vnp,vnq->vpq', jacobian, jacobian)
+        gradient = np.einsum('vnp,vn->vp', jacobian, residuals)
+        diagonal = np.einsum('vpp->vp', normal)
+        damped = normal + (damping[active, None] * diagonal + 1e-12)[:, :, None] * np.eye(normal.shape[1])
+        trial = params[active] - np.linalg.solve(damped, gradient[:, :, None])[:, :, 0]
+        trial[:, 2] = np.clip(trial[:, 2], 0.1 * step, None)
+        if profile == 'pseudo-voigt':
+            trial[:, 5] = np.clip(trial[:, 5], 0, 1)
+        trialCost = np.sum((profile_jacobian(x, trial, profile)[0] - patterns[active]) ** 2, axis=1)
+        accept = trialCost < cost[active]
+        converged = (accept & (cost[active] - trialCost <= tol * cost[active])) | (damping[active] > 1e10)
+        params[active[accept]] = trial[accept]
+        cost[active[accept]] = trialCost[accept]
+        damping[active] = np.where(accept, np.maximum(damping[active] / 10, 1e-7), damping[active] * 10)
+        active = active[~converged]
+    params[:, 1] += middle
+    params[:, 3] -= params[:, 4] * middle
+    params[~valid] = np.nan
+    return params, cost / max(1, x.size - params.shape[1])
+
+
+def fit_tile(x, patterns, profile, iterations, tol):
+    """ fits a (points, rows, columns) tile into (parameters + chi2, rows, columns) maps """
+    shape = patterns.shape[1:]
+    params, chi2 = levenberg_marquardt(x, patterns.reshape(len(x), -1).T, profile, iterations, tol)
+    return np.concatenate([params, chi2[:, None]], axis=1).T.reshape((-1,) + shape)
+
+
+def fit_reconstruction(reconPath, fitPath, window, profile='gaussian', xAxis='tth', tileRows=8, threads=None,
+                       iterations=50, tol=1e-6):
+    """
+    Fits one peak on a linear background in the window (min, max) of xAxis in every voxel of the (xAxis, y, y)
+    reconstruction, by tiles of tileRows image rows read from reconPath and fitted on threads. All voxels of a tile are
+    fitted at once by batched Levenberg-Marquardt with array-level Jacobians. The parameter and chi2 maps are written
+    to fitPath as tiles complete, with the fitted rows flagged so an interrupted fit resumes where it stopped.
+    """
+    if profile not in PARAMETERS:
+        raise ValueError('Peak profile %s not supported' % profile)
+    names = PARAMETERS[profile] + ('chi2',)
+    with h5py.File(reconPath, 'r') as h5In:
+        axis = h5In['entry_0000/%s' % xAxis][:]
+        shape = h5In['entry_0000/data'].shape[1:]
+    points = np.nonzero((axis >= min(window)) & (axis <= max(window)))[0]
+    if len(points) <= len(names):
+        raise ValueError('Fit window %s holds %d points only' % (str(window), len(points)))
+    fitSlice = slice(points[0], points[-1] + 1)
+    x = axis[fitSlice]
+    stat = os.stat(reconPath)
+    # rows fitted from another reconstruction or with other fit settings are not resumed
+    sources = repr((reconPath, stat.st_size, stat.st_mtime_ns, [float(edge) for edge in window], profile,
+                    iterations, float(tol)))
+    if os.path.exists(fitPath):
+        with h5py.File(fitPath, 'r') as h5Fit:
+            current = h5Fit.attrs.get('sources') == sources
+        if not current:
+            os.remove(fitPath)
+    if not os.path.exists(fitPath):
+        with h5py.File(fitPath, 'w') as h5Fit:
+            for name in names:
+                h5Fit.create_dataset('entry_0000/%s' % name, shape, dtype='f', fillvalue=np.nan,
+                                     chunks=(min(tileRows, shape[0]), shape[1]))
+            h5Fit.create_dataset('entry_0000/fitted_rows', (shape[0],), dtype='u1')
+            h5Fit.attrs['sources'] = sources
+            h5Fit.attrs['window'] = np.array(window, dtype=np.float64)
+            h5Fit.attrs['profile'] = profile
+    with h5py.File(fitPath, 'r') as h5Fit:
+        fitted = h5Fit['entry_0000/fitted_rows'][:]
+    tiles = [slice(start, min(start + tileRows, shape[0])) for start in range(0, shape[0], tileRows)
+             if not fitted[start:start + tileRows].all()]
+    print('[INFO] Fitting %d %s peaks in %d tiles of %d rows' % (
+        sum(tile.stop - tile.start for tile in tiles) * shape[1], profile, len(tiles), tileRows))
+    threads = threads or os.cpu_count()
+    with h5py.File(reconPath, 'r') as h5In, h5py.File(fitPath, 'r+') as h5Fit, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        data = h5In['entry_0000/data']
+        pending = []
+        for tile in tiles + [None] * threads:
+            if tile is not None:
+                pending.append((tile, pool.submit(fit_tile, x, data[fitSlice, tile], profile, iterations, tol)))
+            if len(pending) > threads or (tile is None and pending):
+                done, result = pending.pop(0)
+                maps = result.result()
+                for name, values in zip(names, maps):
+                    h5Fit['entry_0000/%s' % name][done] = values
+                h5Fit['entry_0000/fitted_rows'][done] = 1
+                h5Fit.flush()
+    print('[INFO] %s saved!' % fitPath)
@@ -30,29 +30,33 @@ import multiprocessing
 import time
 import os
 
+import h5py
+import numpy as np
+
+import PyXRDCT.nmutils.utils.saveh5 as saveh5
+
 nbprocs = int(multiprocessing.cpu_count())
 try:
     nbprocs = int(os.environ['SLURM_CPUS_ON_NODE'])
 except:
     print("[WARNING] Can't find SLURM_CPUS_ON_NODE")
 
-def integrator(urls, jsonPath, data):
+worker = {}
+
+
+def setup_integrator(config, corrections=True):
+    """
+    Builds the AzimuthalIntegrator from a pyFAI JSON config and loads mask, dark and flat if corrections is set.
+    """
     global detector
-    import os, fabio, json, multiprocessing, pyFAI, pyFAI.azimuthalIntegrator as AI, numpy as np, time, hdf5plugin, h5py, \
-        PyXRDCT.nmutils.utils.saveh5 as saveh5
-    os.environ["OMP_NUM_THREADS"] = "1"
-    with open(jsonPath) as jsonIn:
-        config = json.load(jsonIn)
-    startTime = time.time()
-    mask = fabio.open(config['mask_file']).data
-    if config['do_dark']:
-        dark = fabio.open(config['dark_current'][0]).data
-    else:
-        dark = None
-    if config['do_flat']:
-        flat = fabio.open(config['flat_field'][0]).data
-    else:
-        flat = None
+    import fabio, pyFAI, pyFAI.azimuthalIntegrator as AI
+    mask = dark = flat = None
+    if corrections:
+        mask = fabio.open(config['mask_file']).data
+        if config['do_dark']:
+            dark = fabio.open(config['dark_current'][0]).data
+        if config['do_flat']:
+            flat = fabio.open(config['flat_field'][0]).data
     if config['do_radial_range']:
         radial_range = (config['radial_range_min'], config['radial_range_max'])
     else:
@@ -61,7 +65,6 @@ def integrator(urls, jsonPath, data):
         azimuth_range = (config['azimuth_range_min'], config['azimuth_range_max'])
     else:
         azimuth_range = None
-    method = pyFAI.method_registry.IntegrationMethod.select_method(dim=1, split="full", algo="csc", impl="cython")[0]
     if 'filename' in config['detector_config'].keys():
         detector = pyFAI.detectors.NexusDetector(config['detector_config']['filename'])
     elif 'splineFile' in config['detector_config'].keys():
@@ -76,41 +79,149 @@ def integrator(urls, jsonPath, data):
                                 rot3=config['rot3'],
                                 detector=detector,
                                 wavelength=config['wavelength'])
-    for url in urls:
-        os.sched_setaffinity(0, [int(float(int(url.split('/')[1].split('.')[0])-1) % multiprocessing.cpu_count())])
-        saveIntH5Path = os.path.join(data.savePath, 'h5_pyFAI_integrated', data.dataset + '_pyFAI_%s.h5' % (url.split('/')[1]))
-        checkDoneIntegration = os.path.exists(saveIntH5Path)
-        if checkDoneIntegration:
-            print('%s Already processed!'%url)
+    return ai, mask, dark, flat, radial_range, azimuth_range
+
+
+def integrator_init(jsonPath, data, batched=False, blockSize=8, enginePath=None, output='scan'):
+    """
+    Pool initializer: builds the integrator once per worker.
+    """
+    global worker
+    import os, json, pyFAI
+    from PyXRDCT.core.engine import IntegrationEngine
+    os.environ["OMP_NUM_THREADS"] = "1"
+    with open(jsonPath) as jsonIn:
+        config = json.load(jsonIn)
+    if batched:
+        # mask, dark and flat are already folded in the cached engine
+        ai, mask, dark, flat, radial_range, azimuth_range = setup_integrator(config, corrections=False)
+        engine = IntegrationEngine.load(enginePath)
+        method = pyFAI.method_registry.IntegrationMethod.select_method(dim=1, split="no", algo="histogram", impl="cython")[0]
+    else:
+        ai, mask, dark, flat, radial_range, azimuth_range = setup_integrator(config)
+        engine = None
+        method = pyFAI.method_registry.IntegrationMethod.select_method(dim=1, split="full", algo="csc", impl="cython")[0]
+    worker = {'config': config, 'data': data, 'batched': batched, 'blockSize': blockSize, 'ai': ai, 'mask': mask,
+              'dark': dark, 'flat': flat, 'radial_range': radial_range, 'azimuth_range': azimuth_range,
+              'method': method, 'engine': engine, 'sources': {}, 'output': output}
+
+
+def worker_source(url):
+    """
+    Returns the frame source of a scan, keeping the last opened ones alive between tasks.
+    """
+    from PyXRDCT.nmutils.utils.framesource import FrameSource
+    data = worker['data']
+    sources = worker['sources']
+    if url not in sources:
+        if len(sources) >= 2:
+            sources.pop(next(iter(sources))).close()
+        sources[url] = FrameSource(os.path.join(os.path.dirname(data.dataPath), 'scan%04d/%s_0000.h5' % (
+            int(url.split('/')[1].split('.')[0]), data.xrddetector)), 'entry_0000/measurement/data',
+                                   blockSize=worker['blockSize'], prefetch=1)
+    return sources[url]
+
+
+def integrator(task):
+    """
+    Integrates frames start:stop of a scan and returns them normalised by the monitor, with the radial axis.
+    With per-scan output, the task holding the last frame also writes the NeXus skeleton of the scan file.
+    """
+    url, start, stop, monitor = task
+    config = worker['config']
+    ai = worker['ai']
+    engine = worker['engine']
+    integrateOptions = dict(mask=worker['mask'], method=worker['method'], dark=worker['dark'], flat=worker['flat'],
+                            radial_range=worker['radial_range'], azimuth_range=worker['azimuth_range'],
+                            polarization_factor=float(config['polarization_factor']), unit=config['unit'])
+    source = worker_source(url)
+    result = np.empty((stop - start, config['nbpt_rad']), dtype=np.float32)
+    for first, block in source.blocks(start, stop):
+        if worker['batched']:
+            result[first - start:first - start + len(block)] = engine.integrate(block)
+            radial = engine.radial
+        else:
+            for i, frame in enumerate(block):
+                resultFrame = ai.integrate1d_ng(frame, config['nbpt_rad'], **integrateOptions)
+                result[first - start + i] = resultFrame.intensity
+                radial = resultFrame.radial
+        lastFrame = block[-1].copy()
+    if stop == source.shape[0] and worker['output'] == 'scan':
+        saveIntH5Path = integrated_path(worker['data'], url)
+        resultSave = ai.integrate1d_ng(lastFrame, config['nbpt_rad'], **integrateOptions)
+        saveh5.saveIntegrateH5(saveIntH5Path + '.nx', resultSave, 'XRDCT: pyFAI integration scan %s' % (url.split('/')[1]))
+        if worker['batched']:
+            with h5py.File(saveIntH5Path + '.nx', 'r+') as h5In:
+                del h5In['entry/results/polar_angle']
+                h5In.create_dataset('entry/results/polar_angle', data=engine.radial)
+    return url, start, stop, result / monitor[:, None], np.asarray(radial)
+
+
+def integrated_cube_path(data):
+    return os.path.join(data.savePath, 'h5_pyFAI_integrated', data.dataset + '_pyFAI_cube.h5')
+
+
+def sparse_cube_path(data):
+    return os.path.join(data.savePath, 'h5_pyFAI_integrated', data.dataset + '_pyFAI_sparse_cube.h5')
+
+
+def integrated_path(data, url):
+    return os.path.join(data.savePath, 'h5_pyFAI_integrated', data.dataset + '_pyFAI_%s.h5' % (url.split('/')[1]))
+
+
+class Progress:
+    """
+    Checkpoint record of the frame ranges already integrated, saved as JSON next to the integrated files.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.ranges = {}
+        if os.path.exists(path):
+            with open(path) as jsonIn:
+                self.ranges = json.load(jsonIn)
+
+    def done(self, url):
+        return self.ranges.get(url, [])
+
+    def add(self, url, start, stop):
+        self.ranges.setdefault(url, []).append([start, stop])
+        self.save()
+
+    def clear(self):
+        self.ranges = {}
+        self.save()
+
+    def remove(self, url):
+        self.ranges.pop(url, None)
+        self.save()
+
+    def save(self):
+        with open(self.path + '.tmp', 'w') as jsonOut:
+            json.dump(self.ranges, jsonOut)
+        os.replace(self.path + '.tmp', self.path)
+
+
+def frame_tasks(nframes, done, taskFrames):
+    """
+    Splits the frames not covered by the done ranges into (start, stop) tasks of at most taskFrames frames.
+    """
+    todo = [True] * nframes
+    for start, stop in done:
+        todo[start:stop] = [False] * (stop - start)
+    tasks = []
+    start = 0
+    while start < nframes:
+        if not todo[start]:
+            start += 1
             continue
-        with h5py.File(data.dataPath, 'r') as h5In:
-            frameStackShape = [h5In[url].shape[0],h5In[url].shape[1],h5In[url].shape[2]]
-            result = np.empty((h5In[url].shape[0], config['nbpt_rad']), dtype=np.float32)
-            monitor = h5In[url.split('/')[1]]['measurement'][data.beamMonitor][:] * 1e-6
-        resultBuffer = []
-        readBuffer = np.zeros((frameStackShape[1],frameStackShape[2]),dtype='uint32')
-        with h5py.File(os.path.join(os.path.dirname(data.dataPath),'scan%04d/%s_0000.h5'%(int(url.split('/')[1].split('.')[0]),data.xrddetector)), 'r') as h5In:
-            for image in range(frameStackShape[0]):
-                h5In['entry_0000/measurement/data'].read_direct(readBuffer, np.s_[image,:,:], np.s_[:,:])
-                resultBuffer.append(ai.integrate1d_ng(readBuffer,
-                                                 config['nbpt_rad'],
-                                                 mask=mask,
-                                                 method=method,
-                                                 dark=dark,
-                                                 flat=flat,
-                                                 radial_range=radial_range,
-                                                 azimuth_range=azimuth_range,
-                                                 polarization_factor=float(config['polarization_factor']),
-                                                 unit=config['unit']
-                                                 ).intensity
-                                   )
-            result = resultBuffer / monitor[:,None]
-        resultSave = ai.integrate1d_ng(readBuffer,config['nbpt_rad'],mask=mask,method=method,dark=dark,flat=flat,radial_range=radial_range,azimuth_range=azimuth_range,polarization_factor=float(config['polarization_factor']),unit=config['unit'])
-        saveh5.saveIntegrateH5(saveIntH5Path, resultSave, 'XRDCT: pyFAI integration scan %s' % (url.split('/')[1]))
-        print('[INFO] %s DONE! Took %s seconds!' %(saveIntH5Path,time.time()-startTime))
-        with h5py.File(saveIntH5Path, 'r+') as h5In:
-            del h5In['entry/results/data']
-            h5In.create_dataset('entry/results/data', data=result)
+        stop = start
+        while stop < nframes and todo[stop] and stop - start < taskFrames:
+            stop += 1
+        tasks.append((start, stop))
+        start = stop
+    return tasks
+
 
 class Integrate:
     """
@@ -123,33 +234,169 @@ class Integrate:
         with open(jsonFile) as jsonIn:
             self.config = json.load(jsonIn)
 
-    def wrap(self, chunk):
-        integrator(chunk, self.jsonPath, self.data)
+    def engine_path(self, frameShape):
+        """
+        Returns the path of the integration engine of the config for frames of frameShape, cached in
+        PROCESSED_DATA/pyFAI_engines.
+        """
+        from PyXRDCT.core.engine import cached_engine
+        ai, mask, dark, flat, radial_range, azimuth_range = setup_integrator(self.config)
+        return cached_engine(os.path.join(os.path.dirname(os.path.dirname(self.data.savePath)), 'pyFAI_engines'),
+                             self.config, ai, frameShape, mask=mask, dark=dark, flat=flat, radial_range=radial_range,
+                             azimuth_range=azimuth_range)
 
-    def integrate1d(self):
-        chunks = [self.data.dataUrls[proc::nbprocs] for proc in
-                  range(nbprocs)]
+    def integrate1d(self, batched=False, blockSize=8, taskFrames=256, output='scan'):
+        """
+        Integrates all scans. With batched=True, frames are integrated by blocks of blockSize through a
+        sparse-matrix engine instead of one pyFAI call per frame. The engine is built once per geometry,
+        cached in PROCESSED_DATA/pyFAI_engines and memory-mapped read-only by all workers.
+        Scans are split into tasks of taskFrames frames handed to whichever worker is free. Finished tasks are
+        checkpointed so that an interrupted run restarts from the last completed task.
+        output='scan' writes one NeXus file per scan, output='cube' writes all scans in a single chunked
+        (y, rot, radial) dataset of <dataset>_pyFAI_cube.h5.
+        """
+        enginePath = None
+        if batched:
+            with h5py.File(self.data.dataPath, 'r') as h5In:
+                frameShape = h5In[self.data.dataUrls[0]].shape[1:]
+            enginePath = self.engine_path(frameShape)
+        saveDir = os.path.join(self.data.savePath, 'h5_pyFAI_integrated')
+        if not os.path.exists(saveDir):
+            os.makedirs(saveDir)
+        cubePath = integrated_cube_path(self.data)
+        if output == 'cube':
+            progress = Progress(cubePath + '.progress.json')
+            with h5py.File(self.data.dataPath, 'r') as h5In:
+                shape = (len(self.data.dataUrls), max(h5In[url].shape[0] for url in self.data.dataUrls),
+                         self.config['nbpt_rad'])
+            if saveh5.createIntegratedCube(cubePath, shape, self.data.scans):
+                progress.clear()
+            else:
+                with h5py.File(cubePath, 'r') as h5In:
+                    complete = h5In.attrs.get('complete', False)
+                if complete:
+                    print('%s Already processed!' % cubePath)
+                    return
+        else:
+            progress = Progress(os.path.join(saveDir, self.data.dataset + '_progress.json'))
+        tasks = []
+        remaining = {}
+        nframes = {}
+        assemble = []
+        with h5py.File(self.data.dataPath, 'r') as h5In:
+            for url in self.data.dataUrls:
+                if output == 'scan' and os.path.exists(integrated_path(self.data, url)):
+                    print('%s Already processed!' % url)
+                    continue
+                nframes[url] = h5In[url].shape[0]
+                monitor = h5In[url.split('/')[1]]['measurement'][self.data.beamMonitor][:] * 1e-6
+                if output == 'scan' and not os.path.exists(integrated_path(self.data, url) + '.partial'):
+                    progress.remove(url)
+                for start, stop in frame_tasks(nframes[url], progress.done(url), taskFrames):
+                    tasks.append((url, start, stop, monitor[start:stop]))
+                    remaining[url] = remaining.get(url, 0) + stop - start
+                if progress.done(url) and url in remaining:
+                    print('[INFO] %s resumed, %d frames left' % (url, remaining[url]))
+                elif output == 'scan' and url not in remaining:
+                    # interrupted after its last task: assemble it now, or redo the last frame for its NeXus skeleton
+                    if os.path.exists(integrated_path(self.data, url) + '.nx'):
+                        assemble.append(url)
+                    else:
+                        tasks.append((url, nframes[url] - 1, nframes[url], monitor[-1:]))
+                        remaining[url] = 1
         start_time = time.time()
-        with multiprocessing.Pool(nbprocs) as pool:
-            for _ in pool.imap_unordered(self.wrap, chunks):
-                pass
-        print('[INFO] Took: %4dsec, %4dFPS' % (
+        for url in assemble:
+            self.assemble_scan(url, start_time, progress)
+        cube = None
+        if output == 'cube':
+            cube = h5py.File(cubePath, 'r+')
+            cube.attrs['complete'] = False
+        partials = {}
+        try:
+            with multiprocessing.Pool(nbprocs, initializer=integrator_init,
+                                      initargs=(self.jsonPath, self.data, batched, blockSize, enginePath,
+                                                output)) as pool:
+                for url, start, stop, result, radial in pool.imap_unordered(integrator, tasks):
+                    if output == 'cube':
+                        cube['entry/results/data'][self.data.dataUrls.index(url), start:stop, :] = result
+                        if not cube['entry/results/polar_angle'].attrs.get('filled', False):
+                            cube['entry/results/polar_angle'][:] = radial
+                            cube['entry/results/polar_angle'].attrs['filled'] = True
+                        cube.flush()
+                        progress.add(url, start, stop)
+                        continue
+                    saveIntH5Path = integrated_path(self.data, url)
+                    if url not in partials:
+                        partials[url] = h5py.File(saveIntH5Path + '.partial', 'a')
+                        if 'data' not in partials[url]:
+                            partials[url].create_dataset('data', (nframes[url], self.config['nbpt_rad']),
+                                                         dtype=np.float32)
+                    partials[url]['data'][start:stop] = result
+                    partials[url].flush()
+                    progress.add(url, start, stop)
+                    remaining[url] -= stop - start
+                    if remaining[url] == 0:
+                        partials.pop(url).close()
+                        self.assemble_scan(url, start_time, progress)
+            if cube is not None:
+                cube.attrs['complete'] = True
+                progress.clear()
+        finally:
+            for partial in partials.values():
+                partial.close()
+            if cube is not None:
+                cube.close()
+        if output == 'cube':
+            print('[INFO] %s DONE!' % cubePath)
+        print('[INFO] Took: %4dsec, %4dFPS (%s)' % (
             time.time() - start_time,
-            (len(self.data.dataUrls) * len(self.data.rot[0, :])) / (time.time() - start_time)))
-
-            
-
-        
-        
-        
-        
-        
-        
-        
-        
-        
-        
-        
-        
-        
-        
\ No newline at end of file
+            sum(stop - start for url, start, stop, monitor in tasks) / (time.time() - start_time),
+            'batched' if batched else 'per frame'))
+
+    def assemble_scan(self, url, start_time, progress):
+        """
+        Moves the integrated frames of a scan from its .partial file into its NeXus skeleton and publishes it.
+        """
+        saveIntH5Path = integrated_path(self.data, url)
+        with h5py.File(saveIntH5Path + '.partial', 'r') as partial, h5py.File(saveIntH5Path + '.nx', 'r+') as h5Out:
+            del h5Out['entry/results/data']
+            h5Out.create_dataset('entry/results/data', data=partial['data'][:])
+        os.replace(saveIntH5Path + '.nx', saveIntH5Path)
+        os.remove(saveIntH5Path + '.partial')
+        progress.remove(url)
+        print('[INFO] %s DONE! Took %s seconds!' % (saveIntH5Path, time.time() - start_time))
+
+    def integrate1d_sparse(self):
+        """
+        Integrates the frames segmented by PyXRDCT.core.s3dxrd.segment_scans from their stored pixels only, through
+        the cached integration engine of integrate1d(batched=True). Pixels left out by the segmentation are taken as
+        background, so this suits spotty samples whose diffraction is mostly kept, at a cost that scales with the
+        number of stored pixels instead of the detector size. The dark is only subtracted from raw segmented
+        intensities, not from background subtracted ones. Patterns are normalised by the monitor as in integrate1d
+        and written as the (y, rot, radial) cube <dataset>_pyFAI_sparse_cube.h5, rebuilt on every call.
+        """
+        from PyXRDCT.core.engine import IntegrationEngine
+        segmented = os.path.join(self.data.savePath, 's3dxrd_segmented', self.data.dataset + '_s3dxrd_segmented.h5')
+        cubePath = sparse_cube_path(self.data)
+        # fscans are segmented without their .2 scans
+        scans = [scan for scan in self.data.scans if not scan.endswith('.2')]
+        start_time = time.time()
+        with h5py.File(segmented, 'r') as h5In:
+            first = h5In[scans[0]]
+            frameShape = (int(first.attrs['shape0']), int(first.attrs['shape1']))
+            engine = IntegrationEngine.load(self.engine_path(frameShape))
+            nframes = max(int(h5In[scan].attrs['nframes']) for scan in scans)
+            if os.path.exists(cubePath):
+                os.remove(cubePath)
+            saveh5.createIntegratedCube(cubePath, (len(scans), nframes, self.config['nbpt_rad']), scans)
+            with h5py.File(cubePath, 'r+') as cube:
+                cube['entry/results/polar_angle'][:] = engine.radial
+                for i, scan in enumerate(scans):
+                    g = h5In[scan]
+                    index = g['row'][:].astype(np.int64) * frameShape[1] + g['col'][:]
+                    result = engine.integrate_sparse(index, g['frame'][:], g['intensity'][:], int(g.attrs['nframes']),
+                                                     dark=not g.attrs.get('background', False))
+                    monitor = g['measurement'][self.data.beamMonitor][:] * 1e-6
+                    cube['entry/results/data'][i, :len(result), :] = result / monitor[:, None]
+                cube.attrs['complete'] = True
+        print('[INFO] %s DONE! Took %s seconds!' % (cubePath, time.time() - start_time))
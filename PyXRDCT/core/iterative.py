@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#    Project: PyXRDCT
+#             https://github.com/poautran/PyXRDCT
+#
+#    Copyright (C) 2022-2023 European Synchrotron Radiation Facility, Grenoble,
+#             France
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NON INFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import scipy.sparse
+
+PROJECTOR_ARRAYS = ('data', 'indices', 'indptr')
+
+
+def projector_key(theta, ndet, output_size, circle=True):
+    """
+    Hashes the scan geometry the system matrix depends on.
+    """
+    h = hashlib.sha1(('%d-%d-%d' % (ndet, output_size, circle)).encode())
+    h.update(np.round(np.asarray(theta, dtype=np.float64), 6).tobytes())
+    return h.hexdigest()
+
+
+def build_projector(theta, ndet, output_size, circle=True):
+    """
+    Builds the (angles * detector, output_size ** 2) system matrix of the parallel-beam geometry. Each pixel is
+    spread on its two nearest detector bins with linear weights, so the transpose is exactly the backprojector
+    of PyXRDCT.core.fbp. theta is in degrees.
+    """
+    theta = np.deg2rad(np.asarray(theta, dtype=np.float64))
+    radius = output_size // 2
+    xpr, ypr = np.mgrid[:output_size, :output_size] - radius
+    pixels = np.arange(output_size * output_size)
+    if circle:
+        inside = (xpr ** 2 + ypr ** 2 <= radius ** 2).ravel()
+        xpr, ypr, pixels = xpr.ravel()[inside], ypr.ravel()[inside], pixels[inside]
+    else:
+        xpr, ypr = xpr.ravel(), ypr.ravel()
+    rows, cols, weights = [], [], []
+    for a, angle in enumerate(theta):
+        position = ypr * np.cos(angle) - xpr * np.sin(angle) + ndet // 2
+        valid = (position >= 0) & (position <= ndet - 1)
+        k = np.minimum(position[valid].astype(np.int64), ndet - 2)
+        w = (position[valid] - k).astype(np.float32)
+        for offset, weight in ((0, 1 - w), (1, w)):
+            keep = weight > 0
+            rows.append(a * ndet + k[keep] + offset)
+            cols.append(pixels[valid][keep])
+            weights.append(weight[keep])
+    return scipy.sparse.csr_matrix((np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))),
+                                   shape=(len(theta) * ndet, output_size * output_size), dtype=np.float32)
+
+
+def cached_projector(cachePath, theta, ndet, output_size, circle=True):
+    """
+    Returns the system matrix of the geometry, memory-mapped from cachePath and built there on first use.
+    """
+    path = os.path.join(cachePath, projector_key(theta, ndet, output_size, circle))
+    if not os.path.exists(path):
+        matrix = build_projector(theta, ndet, output_size, circle)
+        os.makedirs(cachePath, exist_ok=True)
+        tmpPath = tempfile.mkdtemp(prefix='.tmp_', dir=cachePath)
+        for name in PROJECTOR_ARRAYS:
+            np.save(os.path.join(tmpPath, name + '.npy'), getattr(matrix, name))
+        try:
+            os.rename(tmpPath, path)
+            print('[INFO] Projector saved in %s' % path)
+        except OSError:
+            shutil.rmtree(tmpPath)
+    arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in PROJECTOR_ARRAYS]
+    return scipy.sparse.csr_matrix(tuple(arrays), shape=(len(theta) * ndet, output_size * output_size), copy=False)
+
+
+def converged(previous, current, tol):
+    return tol > 0 and previous is not None and np.max(np.abs(previous - current) / np.maximum(previous, 1e-30)) < tol
+
+
+def sirt(A, b, iterations=100, tol=0, positivity=True):
+    """
+    SIRT on all columns of b at once: x += C A^T R (b - A x), R and C being the inverse row and column sums.
+    Stops early when the relative change of every column residual is below tol.
+    """
+    rowSum = np.asarray(A.sum(axis=1)).ravel()
+    colSum = np.asarray(A.sum(axis=0)).ravel()
+    R = np.divide(1, rowSum, out=np.zeros_like(rowSum), where=rowSum > 0)[:, None]
+    C = np.divide(1, colSum, out=np.zeros_like(colSum), where=colSum > 0)[:, None]
+    x = np.zeros((A.shape[1], b.shape[1]), dtype=np.float32)
+    previous = None
+    for iteration in range(iterations):
+        residual = b - A.dot(x)
+        x += C * A.T.dot(R * residual)
+        if positivity:
+            np.maximum(x, 0, out=x)
+        current = np.linalg.norm(residual, axis=0)
+        if converged(previous, current, tol):
+            break
+        previous = current
+    return x
+
+
+def cgls(A, b, iterations=20, tol=0):
+    """
+    CGLS on all columns of b at once, with one step length per column.
+    Stops early when the relative change of every column residual is below tol.
+    """
+    x = np.zeros((A.shape[1], b.shape[1]), dtype=np.float32)
+    r = b.astype(np.float32)
+    s = A.T.dot(r)
+    p = s.copy()
+    gamma = np.sum(s ** 2, axis=0)
+    previous = None
+    for iteration in range(iterations):
+        q = A.dot(p)
+        qNorm = np.sum(q ** 2, axis=0)
+        alpha = np.divide(gamma, qNorm, out=np.zeros_like(gamma), where=qNorm > 0)
+        x += alpha * p
+        r -= alpha * q
+        s = A.T.dot(r)
+        gammaNew = np.sum(s ** 2, axis=0)
+        beta = np.divide(gammaNew, gamma, out=np.zeros_like(gamma), where=gamma > 0)
+        p = s + beta * p
+        gamma = gammaNew
+        current = np.linalg.norm(r, axis=0)
+        if converged(previous, current, tol):
+            break
+        previous = current
+    return x
+
+
+def osem(A, b, ndet, iterations=10, subsets=10, tol=0):
+    """
+    Ordered-subset EM on all columns of b at once. Subsets are interleaved angles, rows of A being grouped by angle
+    of ndet detector bins. Stops early when the relative change of every column is below tol.
+    """
+    b = np.maximum(b, 0).astype(np.float32)
+    nangles = A.shape[0] // ndet
+    subsetRows = [(np.arange(a, nangles, subsets)[:, None] * ndet + np.arange(ndet)).ravel() for a in
+                  range(min(subsets, nangles))]
+    subsetMatrices = [A[rows] for rows in subsetRows]
+    sensitivities = [np.asarray(As.sum(axis=0)).ravel()[:, None] for As in subsetMatrices]
+    x = np.ones((A.shape[1], b.shape[1]), dtype=np.float32)
+    x[np.asarray(A.sum(axis=0)).ravel() == 0] = 0
+    for iteration in range(iterations):
+        previous = x.copy()
+        for rows, As, sensitivity in zip(subsetRows, subsetMatrices, sensitivities):
+            projection = As.dot(x)
+            ratio = np.divide(b[rows], projection, out=np.zeros_like(projection), where=projection > 0)
+            x *= np.divide(As.T.dot(ratio), sensitivity, out=np.zeros_like(x), where=sensitivity > 0)
+        change = np.linalg.norm(x - previous, axis=0) / np.maximum(np.linalg.norm(previous, axis=0), 1e-30)
+        if tol > 0 and np.max(change) < tol:
+            break
+    return x
+
+
+def reconstruct(A, sinograms, algorithm, iterations=None, tol=0, subsets=10):
+    """
+    Reconstructs a (detector, angles, channels) block of sinograms with an iterative solver.
+    Returns (channels, output_size, output_size) slices.
+    """
+    ndet, nangles, nchannels = sinograms.shape
+    outputSize = int(np.sqrt(A.shape[1]))
+    b = np.ascontiguousarray(np.transpose(sinograms, (1, 0, 2)), dtype=np.float32).reshape(nangles * ndet, nchannels)
+    if algorithm == 'sirt':
+        x = sirt(A, b, iterations or 100, tol)
+    elif algorithm == 'cgls':
+        x = cgls(A, b, iterations or 20, tol)
+    elif algorithm == 'osem':
+        x = osem(A, b, ndet, iterations or 10, subsets, tol)
+    else:
+        raise ValueError('Reconstruction algorithm %s not supported' % algorithm)
+    return np.ascontiguousarray(x.T).reshape(nchannels, outputSize, outputSize)
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#    Project: PyXRDCT
+#             https://github.com/poautran/PyXRDCT
+#
+#    Copyright (C) 2022-2023 European Synchrotron Radiation Facility, Grenoble,
+#             France
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NON INFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import time
+
+import h5py
+import numpy as np
+
+import PyXRDCT.nmutils.utils.saveh5 as saveh5
+from PyXRDCT.core.integrate import Integrate
+from PyXRDCT.nmutils.utils.readh5 import Input
+
+
+class LiveReconstruction:
+    """
+    Follows a Bliss master file during acquisition: every finished N.1 scan is integrated and its sinogram row is
+    added to a running 3D XRD-CT reconstruction.
+
+    Gridding, shifting and filtered backprojection are linear, so the reconstruction of the sinogram is the sum of
+    the reconstructions of its rows. A row is spread along y by the shift and the ramp filter only, so each new scan
+    costs the filtering of one y profile and one backprojection of its (rot, tth) row. The y grid
+    can't be derived from scans not acquired yet and is given as yRange and ny. The shift is fixed. The rotation
+    grid is taken from the first scan.
+    """
+
+    def __init__(self, dataPath, jsonFile, yRange, ny, shift=0, batched=True, session='Default'):
+        self.data = Input(dataPath, session)
+        self.jsonFile = jsonFile
+        self.yEdges = np.linspace(yRange[0], yRange[1], ny + 1)
+        self.shift = shift
+        self.batched = batched
+        self.added = set()
+        self.sinogram = None
+        self.recon = None
+        self.tth = None
+
+    def setup(self):
+        """
+        Detects detectors and motors once the first scan is in the master file.
+        """
+        self.data.getXrdDetector()
+        self.data.getXrdDetectorMask()
+        self.data.getBeamMonitor()
+        self.data.yMotor()
+        self.data.rotMotor()
+
+    def finished_scans(self):
+        """
+        Reads the scans of the master file that are finished, i.e. that have an end_time, in the scan order of
+        Input.getScanGeometry.
+        """
+        scans, urls, y, rot = [], [], [], []
+        with h5py.File(self.data.dataPath, 'r', locking=False) as h5In:
+            title = h5In['1.1']['title'][()].decode("utf-8").split(' ')[0:2]
+            numbers = sorted(int(scan.split('.')[0]) for scan in h5In.keys() if scan.split('.')[1] == '1')
+            for number in numbers:
+                scan = '%d.1' % number
+                if 'end_time' not in h5In[scan] or h5In[scan]['title'][()].decode("utf-8").split(' ')[0:2] != title:
+                    continue
+                scans.append(scan)
+                urls.append(h5In.get('%s/measurement/%s' % (scan, self.data.xrddetector), getlink=True).path)
+                y.append(h5In['%s/instrument/positioners/%s' % (scan, self.data.yMotor)][()])
+                rot.append(h5In['%s/measurement/%s' % (scan, self.data.rotMotor)][()])
+        return scans, urls, y, rot
+
+    def update(self):
+        """
+        Integrates the scans finished since the last update and adds them to the reconstruction.
+        Returns the number of scans added.
+        """
+        from PyXRDCT.core.fbp import fbp_row
+        from PyXRDCT.core.sinogram import shift_sinograms
+        scans, urls, y, rot = self.finished_scans()
+        new = [i for i, scan in enumerate(scans) if scan not in self.added]
+        if not new:
+            return 0
+        self.data.scans, self.data.dataUrls = scans, urls
+        self.data.y, self.data.rot = np.array(y), rot
+        Integrate(self.data, self.jsonFile).integrate1d(batched=self.batched)
+        if self.sinogram is None:
+            self.rotEdges = np.linspace(np.min(rot[0]), np.max(rot[0]), len(rot[0]) + 1)
+            self.theta = (self.rotEdges[:-1] + self.rotEdges[1:]) / 2
+        for i in new:
+            with h5py.File(os.path.join(self.data.savePath, 'h5_pyFAI_integrated',
+                                        self.data.dataset + '_pyFAI_%s.h5' % (urls[i].split('/')[1])), 'r') as h5In:
+                scanData = h5In['entry/results/data'][:]
+                if self.tth is None:
+                    self.tth = h5In['entry/results/polar_angle'][:]
+            if self.sinogram is None:
+                ny = len(self.yEdges) - 1
+                self.sinogram = np.zeros((ny, len(self.theta), scanData.shape[1]), dtype=np.float32)
+                self.recon = np.zeros((ny, ny, scanData.shape[1]), dtype=np.float32)
+            yBin = np.searchsorted(self.yEdges, np.mean(y[i]), side='right') - 1
+            if np.mean(y[i]) == self.yEdges[-1]:
+                yBin = len(self.yEdges) - 2
+            if not 0 <= yBin < self.sinogram.shape[0]:
+                print('[WARNING] %s at y=%g is outside of the y range, skipped' % (scans[i], np.mean(y[i])))
+                self.added.add(scans[i])
+                continue
+            frames = min(len(rot[i]), len(scanData))
+            # angles jittering past the range of the first scan go to the edge bins
+            rotIndex = np.clip(np.searchsorted(self.rotEdges, rot[i][:frames], side='right') - 1, 0,
+                               len(self.theta) - 1)
+            row = np.zeros(self.sinogram.shape[1:], dtype=np.float32)
+            np.add.at(row, rotIndex, scanData[:frames])
+            profile = np.zeros(self.sinogram.shape[0], dtype=np.float32)
+            profile[yBin] = 1
+            profile = shift_sinograms(profile, self.shift)
+            spread = np.nonzero(profile)[0]
+            self.sinogram[spread] += profile[spread, None, None] * row
+            fbp_row(profile, row, self.theta, self.recon)
+            self.added.add(scans[i])
+            print('[INFO] %s added to the live reconstruction (%d scans)' % (scans[i], len(self.added)))
+        self.save()
+        return len(new)
+
+    def save(self):
+        saveh5.saveReconstructedH5(os.path.join(self.data.savePath, self.data.dataset + '_xrd_live3dreconstruction.h5'),
+                                   self.recon.transpose(2, 0, 1), self.tth, xAxis='tth')
+        saveh5.saveReconstructedH5(os.path.join(self.data.savePath, self.data.dataset + '_xrd_live3dsinogram.h5'),
+                                   self.sinogram.T, self.tth, xAxis='tth')
+
+    def run(self, interval=10, timeout=600):
+        """
+        Polls the master file every interval seconds and stops after timeout seconds without a new scan.
+        """
+        while not os.path.exists(self.data.dataPath):
+            time.sleep(interval)
+        while True:
+            try:
+                with h5py.File(self.data.dataPath, 'r', locking=False) as h5In:
+                    started = '1.1' in h5In
+            except OSError:
+                started = False
+            if started:
+                break
+            time.sleep(interval)
+        self.setup()
+        lastUpdate = time.time()
+        while time.time() - lastUpdate < timeout:
+            if self.update():
+                lastUpdate = time.time()
+            else:
+                time.sleep(interval)
+        print('[INFO] No new scan for %d seconds, live reconstruction stopped' % timeout)
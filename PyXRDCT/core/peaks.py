@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#    Project: PyXRDCT
+#             https://github.com/poautran/PyXRDCT
+#
+#    Copyright (C) 2022-2023 European Synchrotron Radiation Facility, Grenoble,
+#             France
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NON INFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+
+import h5py
+import numpy as np
+
+from PyXRDCT.core.s3dxrd import PEAK_COLUMNS
+
+
+def read_peaks(segmentedPath, scans=None):
+    """
+    Reads the peak tables written by PyXRDCT.core.s3dxrd.segment_scans into one dict of columns, with the number of
+    the scan of each peak in 'scan'.
+    """
+    with h5py.File(segmentedPath, 'r') as h5In:
+        if scans is None:
+            scans = list(h5In.keys())
+        tables = [{name: h5In[scan]['peaks'][name][:] for name in PEAK_COLUMNS} for scan in scans]
+    peaks = {name: np.concatenate([table[name] for table in tables]) for name in PEAK_COLUMNS}
+    peaks['scan'] = np.repeat(np.arange(len(scans), dtype=np.uint32), [len(table['frame']) for table in tables])
+    return peaks
+
+
+class PeakIndex:
+    """
+    Peaks of all the scans of a segmentation, sorted by (dty, omega, radial).
+
+    Peaks of a translation are contiguous and sorted by omega, so a query for an omega range is two binary searches
+    per translation, the radial window being tested on the peaks in between only.
+    """
+
+    def __init__(self, peaks, dtys, offsets):
+        self.peaks = peaks
+        self.dtys = dtys
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, segmentedPath, radialMap, scans=None):
+        """
+        Builds the index from the peak tables of a segmented file. The radial position of every peak is read from
+        radialMap, the radial position of every detector pixel, at the pixel nearest to its centroid.
+        """
+        peaks = read_peaks(segmentedPath, scans)
+        row = np.clip(np.rint(peaks['s_raw']).astype(np.int64), 0, radialMap.shape[0] - 1)
+        col = np.clip(np.rint(peaks['f_raw']).astype(np.int64), 0, radialMap.shape[1] - 1)
+        peaks['radial'] = np.asarray(radialMap[row, col], dtype=np.float32)
+        order = np.lexsort((peaks['radial'], peaks['omega'], peaks['dty']))
+        peaks = {name: column[order] for name, column in peaks.items()}
+        dtys, offsets = np.unique(peaks['dty'], return_index=True)
+        return cls(peaks, dtys, np.append(offsets, len(order)))
+
+    @classmethod
+    def load(cls, path):
+        with h5py.File(path, 'r') as h5In:
+            peaks = {name: h5In['peaks'][name][:] for name in h5In['peaks']}
+            return cls(peaks, h5In['dtys'][:], h5In['offsets'][:])
+
+    def save(self, path, sources=''):
+        """
+        Saves the index, replacing path atomically. sources identifies the segmentation it was built from.
+        """
+        with h5py.File(path + '.partial', 'w') as h5Out:
+            for name, column in self.peaks.items():
+                h5Out.create_dataset('peaks/' + name, data=column)
+            h5Out.create_dataset('dtys', data=self.dtys)
+            h5Out.create_dataset('offsets', data=self.offsets)
+            h5Out.attrs['sources'] = sources
+        os.replace(path + '.partial', path)
+
+    def __len__(self):
+        return len(self.peaks['frame'])
+
+    def select(self, omega=None, radial=None, dty=None):
+        """
+        Returns the positions in the index of the peaks with omega in [omega[0], omega[1]], radial in
+        [radial[0], radial[1]] and dty in [dty[0], dty[1]]. Bounds left to None are not tested.
+        """
+        first, last = 0, len(self.dtys)
+        if dty is not None:
+            first, last = np.searchsorted(self.dtys, dty[0], 'left'), np.searchsorted(self.dtys, dty[1], 'right')
+        selected = []
+        for i in range(first, last):
+            start, stop = self.offsets[i], self.offsets[i + 1]
+            if omega is not None:
+                stop = start + np.searchsorted(self.peaks['omega'][start:stop], omega[1], 'right')
+                start = start + np.searchsorted(self.peaks['omega'][start:stop], omega[0], 'left')
+            index = np.arange(start, stop)
+            if radial is not None:
+                peakRadial = self.peaks['radial'][start:stop]
+                index = index[(peakRadial >= radial[0]) & (peakRadial <= radial[1])]
+            selected.append(index)
+        return np.concatenate(selected) if selected else np.empty(0, np.int64)
+
+    def query(self, omega=None, radial=None, dty=None):
+        """
+        Returns the columns of the peaks within the omega, radial and dty ranges, see select.
+        """
+        index = self.select(omega, radial, dty)
+        return {name: column[index] for name, column in self.peaks.items()}
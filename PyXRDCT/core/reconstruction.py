@@ -25,15 +25,15 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import json
 import multiprocessing
 import os
 
 import h5py
-import matplotlib as mpl
-import matplotlib.pyplot as plt
 import numpy as np
 
 import PyXRDCT.nmutils.utils.saveh5 as saveh5
+from PyXRDCT.core.sharedpool import parallel_iradon
 
 nbprocs = int(multiprocessing.cpu_count())
 try:
@@ -41,15 +41,21 @@ try:
 except:
     print("[WARNING] Can't find SLURM_CPUS_ON_NODE")
 
-mpl.rc('image', cmap='gray')
+
+
+def pyplot():
+    """
+    Imports pyplot for plotting only, matplotlib being slow to import.
+    """
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt
+    mpl.rc('image', cmap='gray')
+    return plt
 
 
 def shift_sino(s, s_shift):
-    from scipy.ndimage import shift
-    sOut = np.zeros(np.shape(s))
-    for i in range(0, np.size(s, 1)):
-        shift(s[:, i], -s_shift, sOut[:, i], mode='nearest')
-    return sOut
+    from PyXRDCT.core.sinogram import shift_sinograms
+    return shift_sinograms(s, s_shift)
 
 
 def no_monitor_norm(s):
@@ -70,10 +76,226 @@ class Reconstruction:
     Initialise reconstruction class
     """
 
-    def __init__(self, readH5Input, intFile=False):
+    def __init__(self, readH5Input, intFile=False, cacheSize=None):
+        from PyXRDCT.core.stagecache import StageCache
         self.data = readH5Input
         if intFile:
             self.integrate = intFile
+        # cacheSize (GB) keeps the intermediate stages under savePath/cache, off by default
+        self.cache = StageCache(os.path.join(self.data.savePath, 'cache'), int((cacheSize or 0) * 1024 ** 3))
+
+    def integrated_cube(self):
+        """
+        Path of the cube of integrate1d(output='cube'), or of the cube of integrate1d_sparse when only that one exists.
+        """
+        cubePath = os.path.join(self.data.savePath, 'h5_pyFAI_integrated', self.data.dataset + '_pyFAI_cube.h5')
+        sparsePath = os.path.join(self.data.savePath, 'h5_pyFAI_integrated', self.data.dataset + '_pyFAI_sparse_cube.h5')
+        if not os.path.exists(cubePath) and os.path.exists(sparsePath):
+            return sparsePath
+        return cubePath
+
+    def use_cube(self):
+        """
+        Whether the integrated data is read from the integrated or sparse integrated cube, see integrated_cube: only
+        once its integration completed, and with one frame per rotation angle.
+        """
+        if not os.path.exists(self.integrated_cube()):
+            return False
+        with h5py.File(self.integrated_cube(), 'r') as h5In:
+            complete = h5In.attrs.get('complete', False)
+            nframes = h5In['entry/results/data'].shape[1]
+        if not complete:
+            print('[WARNING] %s is not complete, reading the per-scan integrated files' % self.integrated_cube())
+            return False
+        if nframes != len(self.data.rot[0]):
+            raise ValueError('%s holds %d frames per scan for %d rotation angles' % (
+                self.integrated_cube(), nframes, len(self.data.rot[0])))
+        return True
+
+    def read_integrated_axis(self):
+        """
+        Reads the radial axis of the integrated data.
+        """
+        if self.use_cube():
+            with h5py.File(self.integrated_cube(), 'r') as h5In:
+                return h5In['entry/results/polar_angle'][:]
+        with h5py.File(os.path.join(self.data.savePath, 'h5_pyFAI_integrated', self.data.dataset + '_pyFAI_1.1.h5'),
+                       'r') as h5In:
+            return h5In['entry/results/polar_angle'][:]
+
+    def read_integrated(self, radialSlice=slice(None)):
+        """
+        Reads integrated patterns as a (y, rot, tth) array, with one hyperslab of the integrated cube if present or
+        from the per-scan integrated files otherwise.
+        """
+        if self.use_cube():
+            with h5py.File(self.integrated_cube(), 'r') as h5In:
+                return h5In['entry/results/data'][:, :, radialSlice]
+        xrdData = None
+        for i, url in enumerate(self.data.dataUrls):
+            with h5py.File(os.path.join(self.data.savePath, 'h5_pyFAI_integrated',
+                                        self.data.dataset + '_pyFAI_%s.h5' % (url.split('/')[1])), 'r') as h5In:
+                scanData = h5In['entry/results/data'][:, radialSlice]
+            if xrdData is None:
+                xrdData = np.empty((len(self.data.y), len(self.data.rot[0]), scanData.shape[1]), dtype=np.float32)
+            xrdData[i, :, :] = scanData
+        return xrdData
+
+    def projector(self, binning=1):
+        """
+        Returns the system matrix of the scan geometry, cached on disk under savePath.
+        """
+        from PyXRDCT.core.iterative import cached_projector
+        if not hasattr(self, 'projectors'):
+            self.projectors = {}
+        if binning not in self.projectors:
+            grid = self.sinogram_grid(binning)
+            self.projectors[binning] = cached_projector(os.path.join(self.data.savePath, 'projectors'), grid.angles,
+                                                        grid.shape[1], grid.shape[1])
+        return self.projectors[binning]
+
+    def integrated_sources(self):
+        """
+        Path, size and modification time of the integrated files the raw cube is read from.
+        """
+        if self.use_cube():
+            paths = [self.integrated_cube()]
+        else:
+            paths = [os.path.join(self.data.savePath, 'h5_pyFAI_integrated',
+                                  self.data.dataset + '_pyFAI_%s.h5' % (url.split('/')[1])) for url in self.data.dataUrls]
+        return [(path, os.stat(path).st_size, os.stat(path).st_mtime_ns) for path in paths]
+
+    def radial_index(self):
+        """
+        Returns the path of the radial index of the integrated data, built on first use or when the integrated files
+        changed. It stores the radial axis, the mean pattern and the cumulative sums of the (y, rot) sinograms along
+        the radial axis, chunked by bin, so the sum over any radial window is the difference of two chunks.
+        """
+        path = os.path.join(self.data.savePath, 'h5_pyFAI_integrated', self.data.dataset + '_radial_index.h5')
+        sources = repr(self.integrated_sources())
+        if os.path.exists(path):
+            with h5py.File(path, 'r') as h5In:
+                if h5In.attrs.get('sources') == sources:
+                    return path
+        tth = self.read_integrated_axis()
+        shape = (len(self.data.y), len(self.data.rot[0]))
+        with h5py.File(path + '.partial', 'w') as h5Out:
+            dsetCumsum = h5Out.create_dataset('cumsum', (len(tth) + 1,) + shape, dtype='f8', chunks=(1,) + shape)
+            dsetCumsum[0] = 0
+            total = np.zeros(shape)
+            mean = np.empty(len(tth))
+            for start in range(0, len(tth), 64):
+                block = self.read_integrated(slice(start, start + 64))
+                cumsum = total[:, :, None] + np.cumsum(block, axis=2, dtype=np.float64)
+                dsetCumsum[start + 1:start + 1 + block.shape[2]] = np.moveaxis(cumsum, 2, 0)
+                mean[start:start + block.shape[2]] = np.average(block, axis=(0, 1))
+                total = cumsum[:, :, -1]
+            h5Out.create_dataset('polar_angle', data=tth)
+            h5Out.create_dataset('mean', data=mean)
+            h5Out.attrs['sources'] = sources
+        os.replace(path + '.partial', path)
+        print('[INFO] Radial index saved in %s' % path)
+        return path
+
+    def radial_window(self, start, stop):
+        """
+        Returns the (y, rot) average of the integrated data over radial bins [start, stop) from the radial index,
+        at least one bin wide and clipped to the radial range.
+        """
+        with h5py.File(self.radial_index(), 'r') as h5In:
+            nbptRad = h5In['cumsum'].shape[0] - 1
+            start = min(max(start, 0), nbptRad - 1)
+            stop = min(max(stop, start + 1), nbptRad)
+            return (h5In['cumsum'][stop] - h5In['cumsum'][start]) / (stop - start)
+
+    def raw_stage(self):
+        """
+        Returns the cached (y, rot, tth) integrated cube and its cache key.
+        """
+        key = self.cache.key('raw', self.integrated_sources())
+        return self.cache.cached(key, self.read_integrated), key
+
+    def gridded_stage(self, binning=1):
+        """
+        Returns the cached (y, rot, tth) gridded sinograms and their cache key.
+        """
+        xrdData, rawKey = self.raw_stage()
+        key = self.cache.key('gridded', rawKey, binning, self.data.y, self.data.rot)
+        return self.cache.cached(key, lambda: self.sinogram_grid(binning).grid(xrdData).astype(np.float32).transpose(
+            1, 0, 2)), key
+
+    def shifted_stage(self, binning=1, shift=0, no_monitor=False):
+        """
+        Returns the cached shifted and normalised (y, rot, tth) sinograms and their cache key.
+        """
+        xrdDataSino, griddedKey = self.gridded_stage(binning)
+        key = self.cache.key('shifted', griddedKey, shift, no_monitor)
+
+        def compute():
+            sinoShift = self.find_center(xrdDataSino.sum(axis=2), binning) if shift is None else shift
+            shifted = shift_sino(xrdDataSino, sinoShift)
+            if no_monitor:
+                shifted = no_monitor_norm(shifted)
+            return shifted
+
+        return self.cache.cached(key, compute), key
+
+    def recon_key(self, algorithm='fbp', binning=1, shift=0, no_monitor=False, iterations=None, tol=0):
+        """
+        Returns the cache key of the reconstruction stage, chained from the stage keys above without computing them.
+        The saved 3D reconstruction is stamped with it.
+        """
+        rawKey = self.cache.key('raw', self.integrated_sources())
+        griddedKey = self.cache.key('gridded', rawKey, binning, self.data.y, self.data.rot)
+        shiftedKey = self.cache.key('shifted', griddedKey, shift, no_monitor)
+        return self.cache.key('recon', shiftedKey, algorithm, iterations, tol)
+
+    def reconstruct_sinograms(self, sinograms, algorithm='fbp', binning=1, iterations=None, tol=0):
+        """
+        Reconstructs a (y, rot, channels) block of sinograms into (channels, y, y) slices.
+        algorithm is 'fbp' or one of the iterative solvers 'sirt', 'cgls' and 'osem', run for iterations or until the
+        relative change of the residuals is below tol.
+        """
+        if algorithm == 'fbp':
+            from PyXRDCT.core.fbp import fbp
+            return fbp(sinograms, self.sinogram_grid(binning).angles, output_size=sinograms.shape[0])
+        if algorithm in ('sirt', 'cgls', 'osem'):
+            from PyXRDCT.core.iterative import reconstruct
+            return reconstruct(self.projector(binning), sinograms, algorithm, iterations, tol)
+        raise ValueError('Reconstruction algorithm %s not supported' % algorithm)
+
+    def reconstruct_compressed(self, sinograms, components, algorithm='fbp', binning=1):
+        """
+        Reconstructs a (y, rot, channels) block of sinograms through its truncated SVD along the channels: only the
+        components sinograms are reconstructed, into (components, y, y) images that expand to any channel with the
+        returned (components, channels) spectra. Only the linear 'fbp' and 'iradon' commute with the expansion.
+        """
+        from PyXRDCT.core import spectral
+        if algorithm not in ('fbp', 'iradon'):
+            raise ValueError('Compressed reconstruction needs a linear algorithm, not %s' % algorithm)
+        componentSinos, singular, spectra = spectral.randomized_svd(sinograms, components)
+        print('[INFO] %d spectral components keep %.6f of the sinogram energy' % (
+            len(singular), np.sum(singular ** 2) / spectral.energy(sinograms)))
+        if algorithm == 'iradon':
+            images = parallel_iradon(componentSinos, self.sinogram_grid(binning).angles, int(len(self.data.y) / binning),
+                                     max(1, multiprocessing.cpu_count() // 2))
+        else:
+            images = self.reconstruct_sinograms(componentSinos, algorithm, binning)
+        return np.asarray(images), spectra, singular
+
+    def read_compressed3d(self, technique='xrd', channels=slice(None)):
+        """
+        Reads a saved spectrally compressed 3D reconstruction ('xrd' or 'xrf') and expands it to the selected
+        channels, returning the (channels, y, y) slices and their axis values.
+        """
+        from PyXRDCT.core.spectral import expand
+        xAxis = 'tth' if technique == 'xrd' else 'energy'
+        with h5py.File(os.path.join(self.data.savePath, '%s_%s_3dcompressed.h5' % (self.data.dataset, technique)),
+                       'r') as h5In:
+            images = h5In['entry_0000/components'][:]
+            spectra = h5In['entry_0000/spectra'][:]
+            axis = h5In['entry_0000/%s' % xAxis][:]
+        return expand(images, spectra, channels), axis[channels]
 
     def parallel_iradon(self, chunk):
         from skimage.transform import iradon
@@ -82,29 +304,42 @@ class Reconstruction:
             recon.append(iradon(chunk[:, :, sino], sorted(self.data.rot[0]), output_size=len(self.data.y)))
         return np.array(recon)
 
+    def sinogram_grid(self, binning=1):
+        """
+        Returns the sinogram gridding of the scan positions, computed once per binning.
+        """
+        from PyXRDCT.core.sinogram import SinogramGrid
+        if not hasattr(self, 'grids'):
+            self.grids = {}
+        if binning not in self.grids:
+            self.grids[binning] = SinogramGrid(self.data.rot, self.data.y, binning)
+        return self.grids[binning]
+
+    def find_center(self, sinogram, binning=1, method='correlation'):
+        """
+        Estimates the rotation-axis shift of a (y, rot) sinogram, see PyXRDCT.core.sinogram.find_center.
+        """
+        from PyXRDCT.core.sinogram import find_center
+        shift = find_center(sinogram, self.sinogram_grid(binning).angles, method)
+        print('[INFO] Estimated center of rotation shift: %.2f' % shift)
+        return shift
+
     def parallel_histogram(self, chunk):
-        import numpy as np
-        sinoFinal = []
-        for data in range(chunk.shape[2]):
-            sino, a, y = np.histogram2d(np.array(self.data.rot).ravel(), np.array(self.data.y).ravel(),
-                                        weights=np.array(chunk[:, :, data]).ravel(),
-                                        bins=(self.data.rot.shape[1], self.data.rot.shape[0]))
-            sinoFinal.append(sino)
-        return np.array(sinoFinal)
+        return np.moveaxis(self.sinogram_grid().grid(chunk), 2, 0)
 
     def reconstruct2d_s3dxrd(self, binning=1, shift=0, plot=False, save=True, no_monitor=False):
         """
         Reconstructs 2D slice of grains from segmented s3DXRD.
+        shift=None estimates the rotation axis shift from the first sinogram.
         """
         from skimage.transform import iradon
         tdxrdData = np.empty((len(self.data.y), len(self.data.rot[0])), dtype=np.float32)
-        with h5py.File(os.path.join(self.data.savePath, 's3dxrd_segmented', self.data.dataset + '_s3dxrd_segmented.h5'),
-                       'r') as h5In:
+        with h5py.File(self.segmented_path(), 'r') as h5In:
             for i, scan in enumerate(self.data.scans):
                 tdxrdData[i] = h5In[scan]['nnz'][:]
-        tdxrdDataSino, a, y = np.histogram2d(np.array(self.data.rot).ravel(), np.array(self.data.y).ravel(),
-                                             weights=np.array(tdxrdData).ravel(), bins=(
-            int(self.data.rot.shape[1] / binning), int(self.data.rot.shape[0] / binning)))
+        tdxrdDataSino = self.sinogram_grid(binning).grid(tdxrdData)
+        if shift is None:
+            shift = self.find_center(tdxrdDataSino.T, binning)
         if no_monitor:
             tdxrdDataRecon = iradon(shift_sino(no_monitor_norm(tdxrdDataSino.T), shift),
                                     sorted(self.data.rot[0][::binning]), circle=True,
@@ -116,6 +351,7 @@ class Reconstruction:
             saveh5.saveReconstructedH5(
                 os.path.join(self.data.savePath, self.data.dataset + '_s3dxrd_2dreconstruction.h5'), tdxrdDataRecon)
         if plot:
+            plt = pyplot()
             plt.figure(figsize=(20, 10))
             plt.subplot(121)
             plt.imshow(tdxrdDataSino)
@@ -125,31 +361,128 @@ class Reconstruction:
             plt.title('%s: Segmented grains reconstruction' % self.data.dataset)
             plt.show()
 
+    def segmented_path(self):
+        return os.path.join(self.data.savePath, 's3dxrd_segmented', self.data.dataset + '_s3dxrd_segmented.h5')
+
+    def segmented_radial_map(self, config):
+        """
+        Returns the radial position of every pixel of the segmented frames for the geometry of the pyFAI config.
+        """
+        from PyXRDCT.core.engine import cached_radial_map
+        with h5py.File(self.segmented_path(), 'r') as h5In:
+            first = h5In[self.data.scans[0]]
+            shape = (first.attrs['shape0'], first.attrs['shape1'])
+        return cached_radial_map(os.path.join(os.path.dirname(os.path.dirname(self.data.savePath)), 'pyFAI_engines'),
+                                 config, shape)
+
+    def peak_index(self, jsonFile):
+        """
+        Returns the PyXRDCT.core.peaks.PeakIndex of the segmented s3DXRD peaks, with radial positions in the unit of
+        the pyFAI JSON config, built on first use or when the segmentation changed.
+        """
+        from PyXRDCT.core.peaks import PeakIndex
+        with open(jsonFile) as jsonIn:
+            config = json.load(jsonIn)
+        segmented = self.segmented_path()
+        path = os.path.join(os.path.dirname(segmented), self.data.dataset + '_peak_index.h5')
+        sources = repr((os.stat(segmented).st_size, os.stat(segmented).st_mtime_ns, config, list(self.data.scans)))
+        if os.path.exists(path):
+            with h5py.File(path, 'r') as h5In:
+                current = h5In.attrs.get('sources') == sources
+            if current:
+                return PeakIndex.load(path)
+        index = PeakIndex.build(segmented, self.segmented_radial_map(config), self.data.scans)
+        index.save(path, sources)
+        print('[INFO] Peak index saved in %s' % path)
+        return index
+
+    def s3dxrd_ring_sinograms(self, jsonFile, tths, width=0.05):
+        """
+        Sums the intensity of the segmented s3DXRD pixels within width of each radial position of tths, in the unit of
+        the pyFAI JSON config, into a (y, rot, ring) array. Pixels are mapped to rings through the cached radial
+        position of every detector pixel, in one pass over the sparse arrays of each scan. Windows must not overlap.
+        """
+        with open(jsonFile) as jsonIn:
+            config = json.load(jsonIn)
+        order = np.argsort(tths)
+        edges = np.ravel([(tths[i] - width, tths[i] + width) for i in order])
+        if np.any(np.diff(edges) <= 0):
+            raise ValueError('Radial windows %s +/- %s overlap' % (list(tths), width))
+        segmented = self.segmented_path()
+        key = self.cache.key('rings', os.stat(segmented).st_size, os.stat(segmented).st_mtime_ns, config, list(tths),
+                             width)
+
+        def compute():
+            rings = np.zeros((len(self.data.y), len(self.data.rot[0]), len(tths)), dtype=np.float32)
+            radial = self.segmented_radial_map(config)
+            with h5py.File(segmented, 'r') as h5In:
+                for i, scan in enumerate(self.data.scans):
+                    g = h5In[scan]
+                    window = np.searchsorted(edges, radial[g['row'][:], g['col'][:]], side='right')
+                    inside = window % 2 == 1
+                    index = g['frame'][:][inside].astype(np.int64) * len(tths) + order[window[inside] // 2]
+                    counts = np.bincount(index, weights=g['intensity'][:][inside], minlength=rings[i].size)
+                    rings[i] = counts[:rings[i].size].reshape(rings.shape[1:])
+            return rings
+
+        return self.cache.cached(key, compute)
+
+    def reconstruct2d_s3dxrd_rings(self, jsonFile, tths=[3, 4], width=0.05, algorithm='fbp', binning=1, shift=0,
+                                   plot=False, save=True, no_monitor=False):
+        """
+        Reconstructs 2D slices of segmented s3DXRD pixels within width of each radial position of tths, without
+        reading raw frames, see s3dxrd_ring_sinograms.
+        shift=None estimates the rotation axis shift from the sum of the ring sinograms.
+        """
+        rings = self.s3dxrd_ring_sinograms(jsonFile, tths, width)
+        ringsSino = self.sinogram_grid(binning).grid(rings).astype(np.float32).transpose(1, 0, 2)
+        if shift is None:
+            shift = self.find_center(ringsSino.sum(axis=2), binning)
+        ringsSino = shift_sino(ringsSino, shift)
+        if no_monitor:
+            ringsSino = no_monitor_norm(ringsSino)
+        ringsRecon = self.reconstruct_sinograms(ringsSino, algorithm, binning)
+        if save:
+            saveh5.saveReconstructedH5(
+                os.path.join(self.data.savePath, self.data.dataset + '_s3dxrd_rings_2dreconstruction.h5'), ringsRecon,
+                tths, xAxis='tth')
+        if plot:
+            plt = pyplot()
+            # sinogram and reconstruction pairs on a grid of about as many rows as pairs per row
+            pairs = int(np.ceil(np.sqrt(len(tths))))
+            rows = int(np.ceil(len(tths) / pairs))
+            fig, axes = plt.subplots(rows, 2 * pairs, figsize=(20, min(20, 20 * rows / (2 * pairs))), squeeze=False)
+            for ax in axes.ravel()[2 * len(tths):]:
+                ax.axis('off')
+            for i, tth in enumerate(tths):
+                ax1, ax2 = axes[i // pairs, 2 * (i % pairs)], axes[i // pairs, 2 * (i % pairs) + 1]
+                ax1.imshow(ringsSino[:, :, i].T, aspect='auto')
+                ax1.set_title('sinogram %s%s +/-%s%s' % (tth, chr(176), width, chr(176)))
+                ax2.imshow(ringsRecon[i])
+                ax2.set_title('reconstruction %s%s +/-%s%s' % (tth, chr(176), width, chr(176)))
+            fig.suptitle('%s: s3DXRD rings' % self.data.dataset)
+            plt.show()
+
     def reconstruct2d_xrdct(self, tths=[3, 4], width=0.05, binning=1, shift=0, plot=False, save=True, no_monitor=False):
         """
         Reconstructs 2D slice of XRD-CT from provided array of energies.
+        shift=None estimates the rotation axis shift from the first sinogram.
         """
-        with h5py.File(os.path.join(self.data.savePath, 'h5_pyFAI_integrated', self.data.dataset + '_pyFAI_1.1.h5'),
-                       'r') as h5In:
-            tthMin = min(h5In['entry/results/polar_angle'][:])
-            tthMax = max(h5In['entry/results/polar_angle'][:])
-            nbptRad = len(h5In['entry/results/polar_angle'][:])
+        with h5py.File(self.radial_index(), 'r') as h5In:
+            tthAxis = h5In['polar_angle'][:]
+            xrdDataAvg = h5In['mean'][:]
+        tthMin = min(tthAxis)
+        tthMax = max(tthAxis)
+        nbptRad = len(tthAxis)
         xrdDataReconSave = []
         from skimage.transform import iradon
         for tth in tths:
             idx = (np.abs(np.linspace(tthMin, tthMax, nbptRad) - tth)).argmin()
             idxWidth = int((nbptRad / (tthMax - tthMin)) * width)
-            xrdDataAvg = []
-            xrdData = np.empty((len(self.data.y), len(self.data.rot[0])), dtype=np.float32)
-            for i, url in enumerate(self.data.dataUrls):
-                with h5py.File(os.path.join(self.data.savePath, 'h5_pyFAI_integrated',
-                                            self.data.dataset + '_pyFAI_%s.h5' % (url.split('/')[1])), 'r') as h5In:
-                    xrdData[i] = np.average(h5In['entry/results/data'][:, idx - idxWidth:idx + idxWidth], axis=1)
-                    xrdDataAvg.append(np.average(h5In['entry/results/data'],axis=0))
-            xrdDataAvg = np.average(np.array(xrdDataAvg),axis=0)
-            xrdDataSino, a, y = np.histogram2d(np.array(self.data.rot).ravel(), np.array(self.data.y).ravel(),
-                                               weights=np.array(xrdData).ravel(), bins=(
-                int(self.data.rot.shape[1] / binning), int(self.data.rot.shape[0] / binning)))
+            xrdData = self.radial_window(idx - idxWidth, idx + idxWidth)
+            xrdDataSino = self.sinogram_grid(binning).grid(xrdData)
+            if shift is None:
+                shift = self.find_center(xrdDataSino.T, binning)
             if no_monitor:
                 xrdDataRecon = iradon(shift_sino(no_monitor_norm(xrdDataSino.T), shift),
                                       sorted(self.data.rot[0][::binning]), circle=True,
@@ -162,6 +495,7 @@ class Reconstruction:
             xrdDataReconCircle = (xpr ** 2 + ypr ** 2) > radius ** 2
             xrdDataRecon[xrdDataReconCircle] = np.average(xrdDataRecon)
             if plot:
+                plt = pyplot()
                 plt.figure(figsize=(plot, plot))
                 ax1 = plt.subplot(221)
                 ax1.imshow(xrdDataSino, aspect='auto')
@@ -187,48 +521,143 @@ class Reconstruction:
             saveh5.saveReconstructedH5(os.path.join(self.data.savePath, self.data.dataset + '_xrd_2dreconstruction.h5'),
                                        xrdDataReconSave, tths, xAxis='tth')
 
-    def reconstruct3d_xrdct(self, algorithm='fbp', binning=1, shift=0, save=True, no_monitor=False,plot=False):
+    def read_reconstructed3d_xrdct(self):
+        """
+        Reads the saved 3D XRD-CT reconstruction, sinograms and tth axis.
+        """
+        with h5py.File(os.path.join(self.data.savePath, self.data.dataset + '_xrd_3dreconstruction.h5'), 'r') as h5In:
+            xrdDataReconSave = h5In['entry_0000/data'][:]
+        with h5py.File(os.path.join(self.data.savePath, self.data.dataset + '_xrd_3dsinogram.h5'), 'r') as h5In:
+            xrdDataSino = h5In['entry_0000/data'][:]
+            tth = h5In['entry_0000/tth'][:]
+        return xrdDataReconSave, xrdDataSino, tth
+
+    def reconstructed_key(self):
+        """
+        Returns the recon_key stamped on the saved 3D XRD-CT reconstruction, or None.
+        """
+        reconPath = os.path.join(self.data.savePath, self.data.dataset + '_xrd_3dreconstruction.h5')
+        if not os.path.exists(reconPath):
+            return None
+        with h5py.File(reconPath, 'r') as h5In:
+            return h5In.attrs.get('key')
+
+    def stamp_reconstructed(self, key):
+        """
+        Stamps the saved 3D XRD-CT reconstruction with its recon_key.
+        """
+        with h5py.File(os.path.join(self.data.savePath, self.data.dataset + '_xrd_3dreconstruction.h5'), 'r+') as h5Out:
+            h5Out.attrs['key'] = key
+
+    def stream_reconstruct3d_xrdct(self, memory, algorithm='fbp', binning=1, shift=0, no_monitor=False,
+                                   iterations=None, tol=0):
+        """
+        Reconstructs the 3D XRD-CT by blocks of tth bins sized to fit in memory (GB). Each block is read, gridded,
+        shifted, reconstructed and written to the output files, so peak memory does not depend on the number of
+        tth bins. A first pass over the data sums all channels when shift=None or no_monitor need it.
+        """
+        reconPath = os.path.join(self.data.savePath, self.data.dataset + '_xrd_3dreconstruction.h5')
+        sinoPath = os.path.join(self.data.savePath, self.data.dataset + '_xrd_3dsinogram.h5')
+        tth = self.read_integrated_axis()
+        grid = self.sinogram_grid(binning)
+        rotBins, yBins = grid.shape
+        # raw block, float64 gridded and shifted sinograms, padded filtered sinograms and reconstructed slices
+        binBytes = 4 * grid.npoints + 16 * rotBins * yBins + 16 * rotBins * yBins + 8 * yBins * yBins
+        blockSize = int(max(1, min(len(tth), memory * 1024 ** 3 // binBytes)))
+        print('[INFO] Streaming reconstruction by blocks of %d tth bins' % blockSize)
+        blocks = [slice(start, min(start + blockSize, len(tth))) for start in range(0, len(tth), blockSize)]
+        if shift is None or no_monitor:
+            xrdDataSum = np.zeros((len(self.data.y), len(self.data.rot[0])))
+            for block in blocks:
+                xrdDataSum += self.read_integrated(block).sum(axis=2)
+            sumSino = grid.grid(xrdDataSum).T
+            if shift is None:
+                shift = self.find_center(sumSino, binning)
+            rowMeans = np.average(shift_sino(sumSino, shift), axis=1) / len(tth)
+        saveh5.createReconstructedH5(reconPath + '.partial', (len(tth), yBins, yBins), tth, xAxis='tth')
+        saveh5.createReconstructedH5(sinoPath + '.partial', (len(tth), rotBins, yBins), tth, xAxis='tth')
+        processes = max(1, multiprocessing.cpu_count() // 2)
+        pool = multiprocessing.Pool(processes) if algorithm == 'iradon' else None
+        try:
+            with h5py.File(reconPath + '.partial', 'r+') as reconOut, h5py.File(sinoPath + '.partial', 'r+') as sinoOut:
+                for block in blocks:
+                    xrdDataSino = shift_sino(grid.grid(self.read_integrated(block)).astype(np.float32).transpose(1, 0, 2),
+                                             shift)
+                    if no_monitor:
+                        xrdDataSino /= rowMeans[:, None, None]
+                    if pool is not None:
+                        xrdDataRecon = parallel_iradon(xrdDataSino, grid.angles, int(len(self.data.y) / binning),
+                                                       processes, pool)
+                    else:
+                        xrdDataRecon = self.reconstruct_sinograms(xrdDataSino, algorithm, binning, iterations, tol)
+                    reconOut['entry_0000/data'][block] = xrdDataRecon
+                    sinoOut['entry_0000/data'][block] = xrdDataSino.T
+        finally:
+            if pool is not None:
+                pool.close()
+        os.rename(reconPath + '.partial', reconPath)
+        os.rename(sinoPath + '.partial', sinoPath)
+        print('[INFO] %s saved!' % reconPath)
+        print('[INFO] %s saved!' % sinoPath)
+
+    def reconstruct3d_xrdct(self, algorithm='fbp', binning=1, shift=0, save=True, no_monitor=False,plot=False,
+                            iterations=None, tol=0, memory=None, components=None):
         """
         Reconstructs 3D dataset of XRD-CT from provided array of energies.
+        algorithm='fbp' uses the batched multithreaded filtered backprojection, 'iradon' the skimage one and
+        'sirt', 'cgls' or 'osem' the iterative solvers, stopped after iterations or at tol.
+        shift=None estimates the rotation axis shift from the sinogram summed over all channels.
+        memory (GB) streams the reconstruction by blocks of tth bins straight to the output files.
+        An existing reconstruction made with the same parameters is read back instead of being recomputed, any other
+        one is replaced. Without memory and with a stage cache
+        (cacheSize), redoing it with another shift, no_monitor or algorithm only recomputes the stages downstream.
+        components compresses the sinograms to that many spectral components before reconstructing them with 'fbp'
+        or 'iradon', and saves the component images and their spectra instead of the full cube.
         """
-        if not os.path.exists(os.path.join(self.data.savePath, self.data.dataset + '_xrd_3dreconstruction.h5')):
-            with h5py.File(os.path.join(self.data.savePath, 'h5_pyFAI_integrated', self.data.dataset + '_pyFAI_1.1.h5'),
-                           'r') as h5In:
-                tth = h5In['entry/results/polar_angle'][:]
-            xrdData = np.empty((len(self.data.y), len(self.data.rot[0]), len(tth)), dtype=np.float32)
-            for i, url in enumerate(self.data.dataUrls):
-                with h5py.File(os.path.join(self.data.savePath, 'h5_pyFAI_integrated',
-                                            self.data.dataset + '_pyFAI_%s.h5' % (url.split('/')[1])), 'r') as h5In:
-                    xrdData[i, :, :] = h5In['entry/results/data'][:]
-            xrdDataSino = np.zeros(
-                (int(self.data.rot.shape[0] / binning), int(self.data.rot.shape[1] / binning), xrdData.shape[2]))
-            for tthVal in range(xrdData.shape[2]):
-                xrdDataSinoBuffer, a, y = np.histogram2d(np.array(self.data.rot).ravel(), np.array(self.data.y).ravel(),
-                                                         weights=np.array(xrdData[:, :, tthVal]).ravel(), bins=(
-                    int(self.data.rot.shape[1] / binning), int(self.data.rot.shape[0] / binning)))
-                xrdDataSino[:, :, tthVal] = shift_sino(xrdDataSinoBuffer.T, shift)
-            chunks = [xrdDataSino[:, :, proc * 100:(proc * 100) + 100] for proc in range(int(xrdData.shape[2] / 100))]
-            xrdDataReconSave = []
-            if no_monitor:
-                xrdDataSino = no_monitor_norm(xrdDataSino)
-            with multiprocessing.Pool(int(multiprocessing.cpu_count() / 2)) as pool:
-                for result in pool.map(self.parallel_iradon, chunks):
-                    xrdDataReconSave.extend(result)
-            xrdDataReconSave = np.array(xrdDataReconSave)
+        if components:
+            tth = self.read_integrated_axis()
+            xrdDataSino = self.shifted_stage(binning, shift, no_monitor)[0]
+            images, spectra, singular = self.reconstruct_compressed(xrdDataSino, components, algorithm, binning)
+            if save:
+                saveh5.saveCompressedH5(os.path.join(self.data.savePath, self.data.dataset + '_xrd_3dcompressed.h5'),
+                                        images, spectra, singular, tth, xAxis='tth')
+            if plot:
+                from PyXRDCT.core.spectral import expand
+                xrdDataReconSave = expand(images, spectra)
+                xrdDataSino = xrdDataSino.T
+        elif self.reconstructed_key() == self.recon_key(algorithm, binning, shift, no_monitor, iterations, tol):
+            print('[INFO] Found already reconstructed datasets!')
+            xrdDataReconSave, xrdDataSino, tth = self.read_reconstructed3d_xrdct()
+        elif memory:
+            self.stream_reconstruct3d_xrdct(memory, algorithm, binning, shift, no_monitor, iterations, tol)
+            self.stamp_reconstructed(self.recon_key(algorithm, binning, shift, no_monitor, iterations, tol))
+            if plot:
+                xrdDataReconSave, xrdDataSino, tth = self.read_reconstructed3d_xrdct()
+        else:
+            tth = self.read_integrated_axis()
+            xrdDataSino, shiftedKey = self.shifted_stage(binning, shift, no_monitor)
+
+            def reconstruct():
+                if algorithm == 'iradon':
+                    return parallel_iradon(xrdDataSino, self.sinogram_grid(binning).angles,
+                                           int(len(self.data.y) / binning), max(1, multiprocessing.cpu_count() // 2))
+                xrdDataReconSave = []
+                for proc in range(0, xrdDataSino.shape[2], 100):
+                    xrdDataReconSave.extend(self.reconstruct_sinograms(xrdDataSino[:, :, proc:proc + 100], algorithm,
+                                                                       binning, iterations, tol))
+                return np.array(xrdDataReconSave)
+
+            reconKey = self.cache.key('recon', shiftedKey, algorithm, iterations, tol)
+            xrdDataReconSave = self.cache.cached(reconKey, reconstruct)
             xrdDataSino = xrdDataSino.T
             if save:
                 saveh5.saveReconstructedH5(os.path.join(self.data.savePath, self.data.dataset + '_xrd_3dreconstruction.h5'),
                                            xrdDataReconSave, tth, xAxis='tth')
                 saveh5.saveReconstructedH5(os.path.join(self.data.savePath, self.data.dataset + '_xrd_3dsinogram.h5'),
                                            xrdDataSino, tth, xAxis='tth')
-        else:
-            print('[INFO] Found already reconstructed datasets!')
-            with h5py.File(os.path.join(self.data.savePath, self.data.dataset + '_xrd_3dreconstruction.h5'),'r') as h5In:
-                xrdDataReconSave = h5In['entry_0000/data'][:]
-            with h5py.File(os.path.join(self.data.savePath, self.data.dataset + '_xrd_3dsinogram.h5'),'r') as h5In:
-                xrdDataSino = h5In['entry_0000/data'][:]
-                tth = h5In['entry_0000/tth'][:]
+                self.stamp_reconstructed(reconKey)
         if plot:
+            plt = pyplot()
             xrdDataAvg = np.average(np.average(xrdDataSino,axis=1),axis=1)
             from matplotlib.widgets import Slider, Button
             def update_tth(val):
@@ -257,10 +686,22 @@ class Reconstruction:
             tth_slider.on_changed(update_tth)
             plt.show()
             
+    def fit3d_xrdct(self, window, profile='gaussian', tileRows=8, threads=None, iterations=50, tol=1e-6):
+        """
+        Fits one Gaussian or pseudo-Voigt peak on a linear background in the tth window (min, max) of every voxel of
+        the saved 3D XRD-CT reconstruction, and writes the area, center, fwhm, background, slope (and eta) maps with
+        the reduced chi2 to _xrd_3dfit.h5.
+        """
+        from PyXRDCT.core.fitting import fit_reconstruction
+        fit_reconstruction(os.path.join(self.data.savePath, self.data.dataset + '_xrd_3dreconstruction.h5'),
+                           os.path.join(self.data.savePath, self.data.dataset + '_xrd_3dfit.h5'), window, profile,
+                           'tth', tileRows, threads or nbprocs, iterations, tol)
+
     def reconstruct2d_xrfct(self, energies=[2.013, 28.612, 49.127, 61.140, 0.5249, 0.0543, 4.952, 28.612, 49.127],
                             binning=1, width=0.05, shift=0, plot=False, save=True, no_monitor=False):
         """
         Reconstructs 2D slice of XRF-CT from provided array of energies.
+        shift=None estimates the rotation axis shift from the first sinogram.
         """
         from skimage.transform import iradon
         ENERGY_MAX = 81.92
@@ -274,9 +715,9 @@ class Reconstruction:
                     xrfData[i] = np.average(
                         h5In[scan]['measurement'][self.data.xrfdetector][:, idx - idxWidth:idx + idxWidth], axis=1) / \
                                  h5In[scan]['measurement'][self.data.beamMonitor][:]
-            xrfDataSino, a, y = np.histogram2d(np.array(self.data.rot).ravel(), np.array(self.data.y).ravel(),
-                                               weights=np.array(xrfData).ravel(), bins=(
-                int(self.data.rot.shape[1] / binning), int(self.data.rot.shape[0] / binning)))
+            xrfDataSino = self.sinogram_grid(binning).grid(xrfData)
+            if shift is None:
+                shift = self.find_center(xrfDataSino.T, binning)
             if no_monitor:
                 xrfDataRecon = iradon(shift_sino(no_monitor_norm(xrfDataSino.T), shift),
                                       sorted(self.data.rot[0][::binning]), circle=True,
@@ -285,6 +726,7 @@ class Reconstruction:
                 xrfDataRecon = iradon(shift_sino(xrfDataSino.T, shift), sorted(self.data.rot[0]), circle=True,
                                       output_size=int(len(self.data.y) / binning))
             if plot:
+                plt = pyplot()
                 plt.figure(figsize=(20, 10))
                 plt.subplot(121)
                 plt.imshow(xrfDataSino)
@@ -299,9 +741,15 @@ class Reconstruction:
             saveh5.saveReconstructedH5(os.path.join(self.data.savePath, self.data.dataset + '_xrf_2dreconstruction.h5'),
                                        xrfDataReconSave, energies, xAxis='Energy')
 
-    def reconstruct3d_xrfct(self, algorithm='fbp', binning=1, shift=0, save=True, no_monitor=False):
+    def reconstruct3d_xrfct(self, algorithm='fbp', binning=1, shift=0, save=True, no_monitor=False, iterations=None,
+                            tol=0, components=None):
         """
         Reconstructs 3D dataset of XRF-CT from provided array of energies.
+        algorithm='fbp' uses the batched multithreaded filtered backprojection, 'iradon' the skimage one and
+        'sirt', 'cgls' or 'osem' the iterative solvers, stopped after iterations or at tol.
+        shift=None estimates the rotation axis shift from the sinogram summed over all channels.
+        components compresses the sinograms to that many spectral components before reconstructing them with 'fbp'
+        or 'iradon', and saves the component images and their spectra instead of the full cube.
         """
         import multiprocessing
         ENERGY_MAX = 81.92
@@ -312,22 +760,26 @@ class Reconstruction:
                 xrfData[i] = h5In[scan]['measurement'][self.data.xrfdetector][:] / h5In[scan]['measurement'][
                                                                                        self.data.beamMonitor][:][:,
                                                                                    None]
-        dataChunks = [xrfData[:, :, proc * 100:(proc * 100) + 100] for proc in range(int(xrfData.shape[2] / 100))]
-        xrfDataSino = []
-        with multiprocessing.Pool(nbprocs) as pool:
-            for result in pool.map(self.parallel_histogram, dataChunks):
-                xrfDataSino.extend(result)
-        xrfDataSino = np.array(xrfDataSino)
-        for energyVal in range(xrfData.shape[2]):
-            xrfDataSino[:, :, energyVal] = shift_sino(xrfDataSino.T, shift)
-        sinoChunks = [xrfDataSino[:, :, proc * 100:(proc * 100) + 100] for proc in range(int(xrfData.shape[2] / 100))]
+        xrfDataSino = self.sinogram_grid().grid(xrfData).transpose(1, 0, 2)
+        if shift is None:
+            shift = self.find_center(xrfDataSino.sum(axis=2))
+        xrfDataSino = shift_sino(xrfDataSino, shift)
+        sinoChunks = [xrfDataSino[:, :, proc:proc + 100] for proc in range(0, xrfData.shape[2], 100)]
         xrfDataReconSave = []
         if no_monitor:
             xrfDataSino = no_monitor_norm(xrfDataSino)
-        with multiprocessing.Pool(nbprocs) as pool:
-            for result in pool.map(self.parallel_iradon, sinoChunks):
-                xrfDataReconSave.extend(result)
-        xrfDataReconSave = np.array(xrfDataReconSave)
+        if components:
+            images, spectra, singular = self.reconstruct_compressed(xrfDataSino, components, algorithm)
+            if save:
+                saveh5.saveCompressedH5(os.path.join(self.data.savePath, self.data.dataset + '_xrf_3dcompressed.h5'),
+                                        images, spectra, singular, energies, xAxis='energy')
+            return
+        if algorithm == 'iradon':
+            xrfDataReconSave = parallel_iradon(xrfDataSino, sorted(self.data.rot[0]), len(self.data.y), nbprocs)
+        else:
+            for chunk in sinoChunks:
+                xrfDataReconSave.extend(self.reconstruct_sinograms(chunk, algorithm, iterations=iterations, tol=tol))
+            xrfDataReconSave = np.array(xrfDataReconSave)
         if save:
             saveh5.saveReconstructedH5(os.path.join(self.data.savePath, self.data.dataset + '_xrf_3dreconstruction.h5'),
                                        xrfDataReconSave, energies, xAxis='energy')
@@ -32,16 +32,24 @@ import multiprocessing
 import os
 import sys
 
-import fabio
 import h5py
 import numba
 import numpy as np
-from ImageD11 import sparseframe, cImageD11
 
 howmany = 10000
+buffers = None
 pixels_in_spot = 5
 thresholds = (4, 8, 16, 32, 64, 128, 256)
 CUT = 5
+# numba threads used by each segmentation worker process
+WORKER_THREADS = 2
+# upper bound on the number of frames read at once by a segmentation worker
+BLOCK_FRAMES = 32
+# columns of the peak table of every scan, named as ImageD11 columnfiles
+PEAK_COLUMNS = ('frame', 's_raw', 'f_raw', 'sum_intensity', 'Number_of_pixels', 'omega', 'dty')
+PEAK_DTYPES = (np.uint32, np.float32, np.float32, np.float32, np.uint32, np.float32, np.float32)
+# number of segmented pixels batched in memory before they are handed to the writer thread
+FLUSH_PIXELS = 1 << 22
 
 
 class bgsub(object):
@@ -52,6 +60,7 @@ class bgsub(object):
         self.bg = None
 
     def __call__(self, input):
+        from ImageD11 import cImageD11
         if self.bg is None:
             self.msk = np.empty(input.shape, np.uint8)
             self.bg = np.empty(input.shape, np.float32)
@@ -64,81 +73,184 @@ class bgsub(object):
         return input - self.bg
 
 
-@numba.njit
-def select(img, msk, row, col, val):
-    cut = CUT
-    # Choose the pixels that are > cut and put into sparse arrays
-    k = 0
+class temporal_bgsub(bgsub):
+    """
+    Background of consecutive frames. The first frame after a reset is estimated along its rows by cImageD11.bgcalc,
+    then the background of every pixel follows the frames by gain times their difference, clipped to
+    sigmap * background + sigmat so that spots passing through the pixel barely raise it.
+    Unlike bgsub, it keeps state between calls and returns a buffer that the next call overwrites.
+    """
+    def __init__(self, gain=0.5, sigmap=0.2, sigmat=15):
+        bgsub.__init__(self, gain, sigmap, sigmat)
+        self.started = False
+
+    def reset(self):
+        """ forgets the background, for a frame that does not follow the previous one """
+        self.started = False
+
+    def __call__(self, input):
+        """ returns the background subtracted frame in float32, in a buffer reused by the next call """
+        from ImageD11 import cImageD11
+        if self.bg is None or self.bg.shape != input.shape:
+            self.msk = np.empty(input.shape, np.uint8)
+            self.bg = np.empty(input.shape, np.float32)
+            self.out = np.empty(input.shape, np.float32)
+            self.started = False
+        if self.started:
+            bgupdate(input, self.bg, self.out, self.gain, self.sigmap, self.sigmat)
+        else:
+            cImageD11.bgcalc(input.astype(np.float32, copy=False),
+                             self.bg,
+                             self.msk,
+                             self.gain,
+                             self.sigmap,
+                             self.sigmat)
+            np.subtract(input, self.bg, out=self.out)
+            self.started = True
+        return self.out
+
+
+@numba.njit(cache=True)
+def bgupdate(img, bg, out, gain, sigmap, sigmat):
+    """ moves bg towards img by gain times their clipped difference and writes img - bg to out """
     for s in range(img.shape[0]):
         for f in range(img.shape[1]):
-            if img[s, f] > cut:
-                if msk[s, f]:  # skip masked
-                    continue
-                row[k] = s
-                col[k] = f
-                val[k] = img[s, f]
-                k += 1
-    return k
-
-
-@numba.njit
-def top_pixels(nnz, row, col, val, howmany):
-    """
-    selects the strongest pixels from a sparse collection
-    - thresholds should be a sorted array of potential cutoff values to try
-    that are higher than the original cutoff used to select data
-    - howmany is the maximum number of pixels to return
-    """
-    # quick return if there are already few enough pixels
-    global thresholds
-    if nnz <= howmany:
-        return nnz
-    # histogram of how many pixels are above each threshold
-    h = np.zeros(len(thresholds), dtype=np.uint32)
-    for k in range(nnz):
-        for i, t in enumerate(thresholds):
-            if val[k] > t:
-                h[i] += 1
-            else:
+            b = bg[s, f]
+            lim = sigmap * abs(b) + sigmat
+            d = min(max(img[s, f] - b, -lim), lim)
+            b += gain * d
+            bg[s, f] = b
+            out[s, f] = img[s, f] - b
+
+
+@numba.njit(parallel=True, cache=True)
+def select_top(img, msk, howmany, hist, row, col, val):
+    """
+    Chooses the unmasked pixels of img that are > CUT and keeps at most howmany of the strongest ones, using the
+    lowest of the thresholds that leaves fewer than howmany pixels. The image is read once, in parallel over row
+    stripes (one per row of hist) that each fill their own part of row, col and val while counting their pixels above
+    every threshold; the kept pixels are then packed at the start of the buffers, in raster order.
+    Returns the number of pixels kept.
+    """
+    nstripe = hist.shape[0]
+    step = (img.shape[0] + nstripe - 1) // nstripe
+    for p in numba.prange(nstripe):
+        for i in range(hist.shape[1]):
+            hist[p, i] = 0
+        k = p * step * img.shape[1]
+        for s in range(p * step, min((p + 1) * step, img.shape[0])):
+            for f in range(img.shape[1]):
+                v = img[s, f]
+                if v > CUT and not msk[s, f]:
+                    row[k] = s
+                    col[k] = f
+                    val[k] = v
+                    k += 1
+                    for i in range(len(thresholds)):
+                        if v > thresholds[i]:
+                            hist[p, i + 1] += 1
+                        else:
+                            break
+        hist[p, 0] = k - p * step * img.shape[1]
+    # level 0 is the plain cut, level i + 1 is thresholds[i]
+    level = 0
+    if hist[:, 0].sum() > howmany:
+        level = len(thresholds)
+        for i in range(len(thresholds)):
+            if hist[:, i + 1].sum() < howmany:
+                level = i + 1
                 break
-    # choose the one to use. This is the first that is lower than howmany
-    tcut = thresholds[-1]
-    for n, t in zip(h, thresholds):
-        if n < howmany:
-            tcut = t
-            break
-    # now we filter the pixels
+    # stripes only move towards the start of the buffers, so they can be packed in place
     n = 0
-    for k in range(nnz):
-        if val[k] > tcut:
-            row[n] = row[k]
-            col[n] = col[k]
-            val[n] = val[k]
-            n += 1
+    for p in range(nstripe):
+        start = p * step * img.shape[1]
+        for k in range(start, start + hist[p, 0]):
             if n >= howmany:
                 break
+            if level == 0 or val[k] > thresholds[level - 1]:
+                row[n] = row[k]
+                col[n] = col[k]
+                val[n] = val[k]
+                n += 1
     return n
 
 
-def choose_parallel(args):
-    """ reads a frame and sends back a sparse frame """
-    h5name, address, frame_num = args
-    with h5py.File(h5name, "r") as h:
-        frm = h[address][frame_num]
-    row = np.empty(msk.size, np.uint16)
-    col = np.empty(msk.size, np.uint16)
-    val = np.empty(msk.size, frm.dtype)
-    nnz = select(frm, msk, row, col, val)
-    global howmany
+def compile_kernels(dtype, mskDtype, background=False):
+    """
+    compiles select_top for frames of dtype and masks of mskDtype, and bgupdate if background is subtracted, or loads
+    them from the numba cache
+    """
+    def signature(*args):
+        return tuple(numba.typeof(arg) for arg in args)
+    if background:
+        bg = np.zeros((1, 1), np.float32)
+        model = temporal_bgsub()
+        bgupdate.compile(signature(np.zeros((1, 1), dtype), bg, bg, model.gain, model.sigmap, model.sigmat))
+        dtype = np.float32
+    row = np.empty(1, np.uint16)
+    val = np.empty(1, dtype)
+    hist = np.empty((1, len(thresholds) + 1), np.int64)
+    select_top.compile(signature(np.zeros((1, 1), dtype), np.zeros((1, 1), mskDtype), howmany, hist, row, row, val))
+
+
+def warmup(dtype, msk, background=False):
+    """
+    Fills the numba cache with the kernels used on frames of dtype so that the segmentation workers load them instead
+    of all compiling them. This is done in a child process: compiling a parallel kernel starts the numba threading
+    layer, which must not be running in the process that forks the workers.
+    """
+    with concurrent.futures.ProcessPoolExecutor(1) as pool:
+        pool.submit(compile_kernels, dtype, msk.dtype, background).result()
+
+
+def scratch(frm):
+    """ per-worker stripe counts and row, col, val buffers, reallocated only when the frame shape or dtype changes """
+    global buffers
+    if buffers is None or buffers[3].dtype != frm.dtype or buffers[3].size != frm.size:
+        nstripe = min(frm.shape[0], 4 * numba.get_num_threads())
+        buffers = (np.empty((nstripe, len(thresholds) + 1), np.int64), np.empty(frm.size, np.uint16),
+                   np.empty(frm.size, np.uint16), np.empty(frm.size, frm.dtype))
+    return buffers
+
+
+def init_worker(mask, threads=1, background=False):
+    """
+    sets the mask and the numba threads of a worker process, with a background model if background is subtracted
+    """
+    global sources, msk, bgmodel
+    sources = {}
+    msk = mask
+    bgmodel = temporal_bgsub() if background else None
+    numba.set_num_threads(min(threads, numba.config.NUMBA_NUM_THREADS))
+
+
+def frame_blocks(nimg, chunks, nworkers):
+    """
+    Splits nimg frames into contiguous (start, stop) blocks aligned on the chunks of the stored detector dataset, see
+    frame_layout, so that every chunk is read and decompressed by a single worker.
+    """
+    step = chunks[0] if chunks is not None else 1
+    nchunks = -(-nimg // step)
+    perBlock = max(1, min(-(-nchunks // (nworkers * 4)), BLOCK_FRAMES // step))
+    size = step * perBlock
+    return [(start, min(start + size, nimg)) for start in range(0, nimg, size)]
+
+
+def segment_frame(frm):
+    """
+    thresholds a frame and sends back a sparse frame of its spots, or None, with the (spots, properties) moments of
+    the spots kept, see cImageD11.s2D_*
+    """
+    from ImageD11 import sparseframe, cImageD11
+    hist, row, col, val = scratch(frm)
+    nnz = select_top(frm, msk, howmany, hist, row, col, val)
+    peaks = None
     if nnz == 0:
         sf = None
     else:
-        if nnz > howmany:
-            nnz = top_pixels(nnz, row, col, val, howmany)
-        # Now get rid of the single pixel 'peaks'
-        s = sparseframe.sparse_frame(row[:nnz].copy(), col[:nnz].copy(),
-                                     frm.shape)
-        s.set_pixels("intensity", val[:nnz].copy())
+        # views on the worker buffers: the spots kept by mask() below are copies
+        s = sparseframe.sparse_frame(row[:nnz], col[:nnz], frm.shape)
+        s.set_pixels("intensity", val[:nnz])
         # label them according to the connected objects
         sparseframe.sparse_connected_pixels(s, threshold=5,
                                             data_name='intensity',
@@ -153,24 +265,133 @@ def choose_parallel(args):
             sf = None
         else:
             sf = s.mask(pxmsk)
-    return frame_num, sf
+            peaks = mom[npx >= pixels_in_spot]
+    return sf, peaks
+
+
+def peak_columns(frame, peaks):
+    """ columns of the peak table, see PEAK_COLUMNS, for the moments of the spots of frame """
+    from ImageD11 import cImageD11
+    intensity = peaks[:, cImageD11.s2D_I]
+    return (np.full(len(peaks), frame, np.uint32), (peaks[:, cImageD11.s2D_sI] / intensity).astype(np.float32),
+            (peaks[:, cImageD11.s2D_fI] / intensity).astype(np.float32), intensity.astype(np.float32),
+            peaks[:, cImageD11.s2D_1].astype(np.uint32))
 
 
-def segment_scans(h5FileIn):
+def worker_source(path, address):
+    """
+    Returns the frame source of a scan, keeping the last opened ones alive between blocks.
+    """
+    from PyXRDCT.nmutils.utils.framesource import FrameSource
+    if (path, address) not in sources:
+        if len(sources) >= 2:
+            sources.pop(next(iter(sources))).close()
+        sources[path, address] = FrameSource(path, address, blockSize=BLOCK_FRAMES, prefetch=0,
+                                             threads=WORKER_THREADS)
+    return sources[path, address]
+
+
+def choose_parallel(args):
+    """
+    Reads a block of frames through the worker's frame source of the scan and sends back its sparse frames packed
+    end to end with the peak table of their spots: (start, nnz per frame, row, col, intensity, peak columns)
+    """
+    path, address, start, stop = args
+    source = worker_source(path, address)
+    # frames are copied out by the segmentation, so the block buffer of the source is reused
+    slot = source.ring[0]
+    frms = source.read(start, stop, slot[:stop - start] if stop - start <= len(slot) else None)
+    nnz = np.zeros(stop - start, np.uint32)
+    row, col, val, peaks = [], [], [], []
+    if bgmodel is not None:
+        # blocks are not given to a worker in order: the model restarts on each of them
+        bgmodel.reset()
+    for i, frm in enumerate(frms):
+        if bgmodel is not None:
+            frm = bgmodel(frm)
+        sf, framePeaks = segment_frame(frm)
+        if sf is None:
+            continue
+        nnz[i] = sf.nnz
+        row.append(sf.row)
+        col.append(sf.col)
+        val.append(sf.pixels['intensity'])
+        peaks.append(peak_columns(start + i, framePeaks))
+    if not row:
+        return (start, nnz, np.empty(0, np.uint16), np.empty(0, np.uint16), np.empty(0, frm.dtype),
+                tuple(np.empty(0, columnType) for columnType in PEAK_DTYPES[:5]))
+    return (start, nnz, np.concatenate(row), np.concatenate(col), np.concatenate(val),
+            tuple(np.concatenate(column) for column in zip(*peaks)))
+
+
+def grow(dset, size):
+    """ resizes a 1D dataset geometrically so that it holds at least size elements """
+    if size > len(dset):
+        dset.resize(max(size, 2 * len(dset)), axis=0)
+
+
+def pack(results, omega, dty):
+    """
+    concatenates consecutive block results into one (start, nnz, row, col, intensity, frame, peak columns) batch,
+    completing the peak table with the omega of their frame and dty of the scan
+    """
+    start = results[0][0]
+    nframe = np.concatenate([result[1] for result in results])
+    frame = np.repeat(np.arange(start, start + len(nframe), dtype=np.uint32), nframe)
+    row, col, val = (np.concatenate([result[i] for result in results]) for i in (2, 3, 4))
+    peaks = [np.concatenate(column) for column in zip(*[result[5] for result in results])]
+    peaks += [np.asarray(omega, np.float32)[peaks[0]], np.full(len(peaks[0]), dty, np.float32)]
+    return start, nframe, row, col, val, frame, peaks
+
+
+def write_batch(g, npx, npeaks, batch):
+    """
+    writes a batch of sparse frames to the datasets of scan group g, after its first npx pixels and npeaks peaks
+    """
+    start, nframe, row, col, val, frame, peaks = batch
+    g['nnz'][start:start + len(nframe)] = nframe
+    for name, data in zip(('row', 'col', 'intensity', 'frame'), (row, col, val, frame)):
+        grow(g[name], npx + len(data))
+        g[name][npx:npx + len(data)] = data
+    for name, data in zip(PEAK_COLUMNS, peaks):
+        grow(g['peaks'][name], npeaks + len(data))
+        g['peaks'][name][npeaks:npeaks + len(data)] = data
+
+
+def trim(g, npx, npeaks):
+    """ shrinks the sparse datasets of scan group g to the npx pixels and npeaks peaks written """
+    for name in ('row', 'col', 'intensity', 'frame'):
+        g[name].resize(npx, axis=0)
+    for name in PEAK_COLUMNS:
+        g['peaks'][name].resize(npeaks, axis=0)
+    print("[INFO] Scan %s DONE! Found %d pixels in %d spots" % (g.name.strip('/'), npx, npeaks))
+    sys.stdout.flush()
+
+
+def segment_scans(h5FileIn, background=False):
     """ Does segmentation on a series of scans in hdf files:
+    - background: subtracts a background model following consecutive frames before thresholding, intensities are
+    then stored in float32
+    All the scans are segmented by one pool of workers. Their results are batched in memory and written in large
+    blocks by a writer thread, so that the writing of a scan overlaps the segmentation of the next ones.
     """
+    import fabio
+    from PyXRDCT.nmutils.utils.framesource import frame_layout
     opts = {'chunks': (10000,), 'maxshape': (None,), 'compression': 'lzf', 'shuffle': True}
     ndone = 0
     outname = os.path.join(h5FileIn.savePath, 's3dxrd_segmented', h5FileIn.dataset + '_s3dxrd_segmented.h5')
     if not os.path.exists(os.path.dirname(outname)):
         os.makedirs(os.path.dirname(outname))
+    msk = 1 - fabio.open(h5FileIn.xrddetectorMask).data
+    nworkers = max(1, multiprocessing.cpu_count() // WORKER_THREADS)
     with h5py.File(outname, "w") as hout:
-        for scan in h5FileIn.scans:
-            if scan.endswith(".2"):  # for fscans
-                continue
-            with h5py.File(h5FileIn.dataPath, "r") as hin:
-                hout.attrs['h5input'] = h5FileIn.dataPath
-                hdr = {}
+        hout.attrs['h5input'] = h5FileIn.dataPath
+        todo = []
+        dtype = None
+        with h5py.File(h5FileIn.dataPath, "r") as hin:
+            for scan in h5FileIn.scans:
+                if scan.endswith(".2"):  # for fscans
+                    continue
                 g = hout.create_group(scan)
                 gm = g.create_group('measurement')
                 gm.create_dataset(h5FileIn.rotMotor, data=hin[scan]['measurement'][h5FileIn.rotMotor][:])
@@ -178,43 +399,59 @@ def segment_scans(h5FileIn):
                 gip = g.create_group('instrument/positioners')
                 gip.create_dataset(h5FileIn.yMotor, data=hin[scan]['instrument/positioners'][h5FileIn.yMotor][()])
                 frms = hin[scan]['measurement'][h5FileIn.xrddetector]
-                row = g.create_dataset('row', (1,), dtype=np.uint16, **opts)
-                col = g.create_dataset('col', (1,), dtype=np.uint16, **opts)
-                # can go over 65535 frames in a scan 
-                num = g.create_dataset('frame', (1,), dtype=np.uint32, **opts)
-                sig = g.create_dataset('intensity', (1,), dtype=frms.dtype, **opts)
-                nnz = g.create_dataset('nnz', (frms.shape[0],), dtype=np.uint32)
+                g.create_dataset('row', (0,), dtype=np.uint16, **opts)
+                g.create_dataset('col', (0,), dtype=np.uint16, **opts)
+                # can go over 65535 frames in a scan
+                g.create_dataset('frame', (0,), dtype=np.uint32, **opts)
+                g.create_dataset('intensity', (0,), dtype=np.float32 if background else frms.dtype, **opts)
+                g.create_dataset('nnz', (frms.shape[0],), dtype=np.uint32)
+                for name, columnType in zip(PEAK_COLUMNS, PEAK_DTYPES):
+                    g.create_dataset('peaks/' + name, (0,), dtype=columnType, **opts)
                 g.attrs['itype'] = np.dtype(np.uint16).name
+                g.attrs['background'] = bool(background)
                 g.attrs['nframes'] = frms.shape[0]
                 g.attrs['shape0'] = frms.shape[1]
                 g.attrs['shape1'] = frms.shape[2]
-                global msk
-                msk = 1 - fabio.open(h5FileIn.xrddetectorMask).data
+                # frames are read from the lima file behind the virtual dataset of the master file
+                path, address, chunks = frame_layout(hin, scan + "/measurement/" + h5FileIn.xrddetector)
+                todo.append((g, [(path, address, start, stop)
+                                 for start, stop in frame_blocks(frms.shape[0], chunks, nworkers)],
+                             gm[h5FileIn.rotMotor][:], gip[h5FileIn.yMotor][()]))
+                ndone += frms.shape[0]
+                if dtype is None:
+                    dtype = frms.dtype
+        if dtype is None:
+            return ndone
+        warmup(dtype, msk, background)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=nworkers, initializer=init_worker,
+                                                    initargs=(msk, WORKER_THREADS, background)) as pool, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=1) as writer:
+            # blocks of all scans in order, with a bounded number in flight so that results finished ahead of
+            # the scan being written do not pile up in memory
+            pending = iter([block for g, blocks, omega, dty in todo for block in blocks])
+            window = []
+            writes = []
+            for g, blocks, omega, dty in todo:
                 npx = 0
-                address = scan + "/measurement/" + h5FileIn.xrddetector
-                nimg = frms.shape[0]
-                args = [(h5FileIn.dataPath, address, i) for i in range(nimg)]
-            chunksize = max(1, len(args) // multiprocessing.cpu_count() // 8)
-            for i, spf in concurrent.futures.ProcessPoolExecutor(max_workers=multiprocessing.cpu_count()).map(
-                    choose_parallel, args, chunksize=chunksize, timeout=60):
-                if spf is None:
-                    nnz[i] = 0
-                    continue
-                if spf.nnz + npx > len(row):
-                    row.resize(spf.nnz + npx, axis=0)
-                    col.resize(spf.nnz + npx, axis=0)
-                    sig.resize(spf.nnz + npx, axis=0)
-                    num.resize(spf.nnz + npx, axis=0)
-                row[npx:] = spf.row[:]
-                col[npx:] = spf.col[:]
-                sig[npx:] = spf.pixels['intensity']
-                num[npx:] = i
-                nnz[i] = spf.nnz
-                npx += spf.nnz
-            ndone += nimg
-            try:
-                print("[INFO] Scan %s DONE! Found %d spots" % (scan, spf.nnz))
-            except:
-                print("[INFO] Scan %s DONE! Found 0 spot" % scan)
-            sys.stdout.flush()
+                npeaks = 0
+                results = []
+                for i in range(len(blocks)):
+                    while len(window) < 2 * nworkers:
+                        block = next(pending, None)
+                        if block is None:
+                            break
+                        window.append(pool.submit(choose_parallel, block))
+                    results.append(window.pop(0).result(timeout=60 * BLOCK_FRAMES))
+                    if sum(len(result[2]) for result in results) >= FLUSH_PIXELS or i == len(blocks) - 1:
+                        batch = pack(results, omega, dty)
+                        writes.append(writer.submit(write_batch, g, npx, npeaks, batch))
+                        npx += len(batch[2])
+                        npeaks += len(batch[6][0])
+                        results = []
+                    # keep at most a couple of batches waiting for the writer
+                    while len(writes) > 2:
+                        writes.pop(0).result()
+                writes.append(writer.submit(trim, g, npx, npeaks))
+            for write in writes:
+                write.result()
     return ndone
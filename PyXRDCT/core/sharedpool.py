@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#    Project: PyXRDCT
+#             https://github.com/poautran/PyXRDCT
+#
+#    Copyright (C) 2022-2023 European Synchrotron Radiation Facility, Grenoble,
+#             France
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NON INFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import multiprocessing
+import os
+import tempfile
+
+import numpy as np
+
+SHARED_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+def shared_empty(shape, dtype=np.float32):
+    """
+    Allocates an array on a memory-mapped file that worker processes open from its filename.
+    """
+    fd, path = tempfile.mkstemp(prefix='pyxrdct_', suffix='.dat', dir=SHARED_DIR)
+    os.close(fd)
+    return np.memmap(path, dtype=dtype, mode='w+', shape=tuple(shape))
+
+
+def shared_copy(array):
+    shared = shared_empty(array.shape, array.dtype)
+    shared[...] = array
+    return shared
+
+
+def shared_view(array):
+    """
+    Returns whether array is a whole C-contiguous memory-mapped file, like the .npy files of the stage cache, that
+    workers can open directly instead of a shared copy.
+    """
+    return (isinstance(array, np.memmap) and array.filename is not None and array.flags.c_contiguous and
+            os.path.exists(array.filename) and array.offset + array.nbytes == os.path.getsize(array.filename))
+
+
+def shared_spec(array):
+    return array.filename, array.offset, array.shape, array.dtype.str
+
+
+def shared_open(spec, mode='r'):
+    path, offset, shape, dtype = spec
+    return np.memmap(path, dtype=dtype, mode=mode, shape=shape, offset=offset)
+
+
+def release(*arrays):
+    """
+    Removes the files behind shared arrays. The mappings stay valid until the arrays are garbage collected.
+    """
+    for array in arrays:
+        if os.path.exists(array.filename):
+            os.unlink(array.filename)
+
+
+def iradon_task(task):
+    """
+    Reconstructs a channel range of the shared sinograms in place in the shared output volume.
+    """
+    from skimage.transform import iradon
+    sinoSpec, reconSpec, theta, outputSize, start, stop = task
+    sinograms = shared_open(sinoSpec)
+    recon = shared_open(reconSpec, 'r+')
+    for channel in range(start, stop):
+        recon[channel] = iradon(sinograms[:, :, channel], theta, output_size=outputSize)
+    return start, stop
+
+
+def parallel_iradon(sinograms, theta, output_size, processes, pool=None):
+    """
+    Reconstructs (y, rot, channels) sinograms into (channels, output_size, output_size) slices with skimage iradon
+    on processes workers, or on a running pool of that many workers reused across calls. Sinograms that are
+    already a memory-mapped file, like a cached stage, are opened by the workers in place; others are copied once
+    to a shared memory map. Tasks only carry filenames and a channel range, and workers write slices in place in
+    the shared output volume.
+    """
+    shared = not shared_view(sinograms)
+    if shared:
+        sinograms = shared_copy(np.asarray(sinograms, dtype=np.float32))
+    recon = shared_empty((sinograms.shape[2], output_size, output_size))
+    step = max(1, int(np.ceil(sinograms.shape[2] / (4 * processes))))
+    tasks = [(shared_spec(sinograms), shared_spec(recon), list(theta), output_size, start,
+              min(start + step, sinograms.shape[2])) for start in range(0, sinograms.shape[2], step)]
+    try:
+        if pool is None:
+            with multiprocessing.Pool(processes) as pool:
+                for done in pool.imap_unordered(iradon_task, tasks):
+                    pass
+        else:
+            for done in pool.imap_unordered(iradon_task, tasks):
+                pass
+    finally:
+        release(recon)
+        if shared:
+            release(sinograms)
+    return recon
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#    Project: PyXRDCT
+#             https://github.com/poautran/PyXRDCT
+#
+#    Copyright (C) 2022-2023 European Synchrotron Radiation Facility, Grenoble,
+#             France
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NON INFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import numpy as np
+import scipy.sparse
+
+
+def bin_index(values, nbins):
+    """
+    Bin index of each value on nbins regular bins spanning the values, as np.histogram2d assigns them.
+    """
+    vmin, vmax = float(np.min(values)), float(np.max(values))
+    if vmin == vmax:
+        vmin, vmax = vmin - 0.5, vmax + 0.5
+    edges = np.linspace(vmin, vmax, nbins + 1)
+    index = np.searchsorted(edges, values, side='right') - 1
+    index[values == edges[-1]] = nbins - 1
+    return index
+
+
+class SinogramGrid:
+    """
+    Gridding of the (y, rot) scan positions on the sinogram, computed once and applied to all channels.
+
+    The flat bin index of every frame is stored as a sparse (bins, frames) matrix so a whole (y, rot, channels)
+    block is gridded with one sparse x dense product. Results are those of np.histogram2d on (rot, y).
+    angles holds the mean rotation of the frames falling in each rot bin.
+    """
+
+    def __init__(self, rot, y, binning=1):
+        rot = np.asarray(rot)
+        y = np.asarray(y)
+        self.shape = (int(rot.shape[1] / binning), int(rot.shape[0] / binning))
+        rotIndex = bin_index(rot.ravel(), self.shape[0])
+        yIndex = bin_index(y.ravel(), self.shape[1])
+        self.index = rotIndex * self.shape[1] + yIndex
+        self.npoints = self.index.size
+        self.counts = np.bincount(self.index, minlength=self.shape[0] * self.shape[1]).reshape(self.shape)
+        rotCounts = self.counts.sum(axis=1)
+        edges = np.linspace(rot.min(), rot.max(), self.shape[0] + 1)
+        self.angles = (edges[:-1] + edges[1:]) / 2
+        self.angles[rotCounts > 0] = (np.bincount(rotIndex, weights=rot.ravel(), minlength=self.shape[0])[
+                                          rotCounts > 0] / rotCounts[rotCounts > 0])
+        self.matrix = scipy.sparse.csr_matrix((np.ones(self.npoints), (self.index, np.arange(self.npoints))),
+                                              shape=(self.shape[0] * self.shape[1], self.npoints))
+
+    def grid(self, data):
+        """
+        Grids (y, rot) or (y, rot, channels) data into a (rot, y) or (rot, y, channels) float64 sinogram.
+        """
+        data = np.asarray(data)
+        if data.ndim == 2:
+            return np.bincount(self.index, weights=data.ravel(),
+                               minlength=self.shape[0] * self.shape[1]).reshape(self.shape)
+        block = data.reshape(self.npoints, -1)
+        return np.asarray(self.matrix.dot(block)).reshape(self.shape + (block.shape[1],))
+
+
+def shift_sinograms(sinograms, shift):
+    """
+    Shifts sinograms by -shift along their first (y) axis, all trailing axes at once, with a Fourier phase ramp.
+    The y axis is edge-padded first so borders behave as scipy.ndimage.shift(mode='nearest').
+    """
+    from scipy import fft
+    sinograms = np.asarray(sinograms)
+    if not shift:
+        return np.array(sinograms)
+    dtype = np.float32 if sinograms.dtype == np.float32 else np.float64
+    size = sinograms.shape[0]
+    pad = int(np.ceil(abs(shift))) + 1
+    columns = sinograms.reshape(size, -1)
+    out = np.empty(columns.shape, dtype=dtype)
+    ramp = np.exp(2j * np.pi * fft.rfftfreq(size + 2 * pad) * shift).astype(
+        np.complex64 if dtype == np.float32 else np.complex128)[:, None]
+    blockColumns = max(1, 2 ** 22 // (size + 2 * pad))
+    for start in range(0, columns.shape[1], blockColumns):
+        block = np.pad(columns[:, start:start + blockColumns].astype(dtype, copy=False), ((pad, pad), (0, 0)),
+                       mode='edge')
+        shifted = fft.irfft(fft.rfft(block, axis=0, workers=-1) * ramp, n=block.shape[0], axis=0, workers=-1)
+        out[:, start:start + blockColumns] = shifted[pad:pad + size]
+    return out.reshape(sinograms.shape)
+
+
+def opposing_pairs(theta):
+    """
+    Pairs of projection indices 180 degrees apart, within half an angular step.
+    """
+    theta = np.asarray(theta, dtype=np.float64) % 360
+    step = np.median(np.diff(np.sort(theta))) if theta.size > 1 else 0
+    pairs = []
+    for i, angle in enumerate(theta):
+        distance = np.abs((theta - angle - 180 + 180) % 360 - 180)
+        j = int(np.argmin(distance))
+        if distance[j] <= step / 2 and i < j:
+            pairs.append((i, j))
+    return pairs
+
+
+def correlation_center(sinogram, pairs):
+    """
+    Rotation-axis shift from the summed cross-correlation of opposing projections, one of them mirrored.
+    """
+    from scipy import fft
+    size = sinogram.shape[0]
+    first = sinogram[:, [i for i, j in pairs]]
+    second = sinogram[::-1, [j for i, j in pairs]]
+    first = first - first.mean(axis=0)
+    second = second - second.mean(axis=0)
+    correlation = fft.irfft(np.sum(np.conj(fft.rfft(first, 2 * size, axis=0)) * fft.rfft(second, 2 * size, axis=0),
+                                   axis=1), 2 * size)
+    peak = int(np.argmax(correlation))
+    left, centre, right = correlation[peak - 1], correlation[peak], correlation[(peak + 1) % (2 * size)]
+    curvature = left - 2 * centre + right
+    offset = peak + (0.5 * (left - right) / curvature if curvature < 0 else 0)
+    if offset > size:
+        offset -= 2 * size
+    # the mirrored opposing projection is the direct one moved by 2 * center - size + 1
+    return (size - 1 - offset) / 2 - size // 2
+
+
+def sharpness_center(sinogram, theta, maxSize=128):
+    """
+    Rotation-axis shift minimising the negative part of filtered backprojections, where a misplaced axis shows up
+    as dark arcs. Only the first 180 degrees are used. Integer shifts are searched on a sinogram downsampled to
+    maxSize, then refined on quarter pixels at full size.
+    """
+    from PyXRDCT.core.fbp import fbp
+    theta = np.asarray(theta, dtype=np.float64)
+    halfTurn = (theta - theta.min()) < 180
+    sinogram, theta = sinogram[:, halfTurn], theta[halfTurn]
+
+    def negativity(data, shifts):
+        stack = np.stack([shift_sinograms(data, s) for s in shifts], axis=2)
+        recon = fbp(stack, theta, output_size=data.shape[0]).reshape(len(shifts), -1)
+        return -np.sum(np.minimum(recon, 0), axis=1) / np.maximum(np.sum(np.abs(recon), axis=1), 1e-30)
+
+    factor = max(1, int(np.ceil(sinogram.shape[0] / maxSize)))
+    size = sinogram.shape[0] // factor
+    small = sinogram[:size * factor].reshape(size, factor, -1).mean(axis=1)
+    shifts = np.arange(-(size // 4), size // 4 + 1, dtype=np.float64)
+    best = shifts[np.argmin(negativity(small, shifts))] * factor
+    shifts = best + np.arange(-factor, factor + 0.25, 0.25)
+    return shifts[np.argmin(negativity(sinogram, shifts))]
+
+
+def find_center(sinogram, theta, method='correlation'):
+    """
+    Estimates the shift centring the rotation axis of a (y, rot) sinogram, e.g. summed over all channels, in
+    the convention of shift_sinograms. method='correlation' matches opposing projections and falls back to
+    'sharpness', a search on filtered backprojections, when the scan has no projections 180 degrees apart.
+    """
+    sinogram = np.asarray(sinogram, dtype=np.float64)
+    if method == 'correlation':
+        pairs = opposing_pairs(theta)
+        if pairs:
+            return correlation_center(sinogram, pairs)
+        method = 'sharpness'
+    if method == 'sharpness':
+        return sharpness_center(sinogram, theta)
+    raise ValueError('Center-of-rotation method %s not supported' % method)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#    Project: PyXRDCT
+#             https://github.com/poautran/PyXRDCT
+#
+#    Copyright (C) 2022-2023 European Synchrotron Radiation Facility, Grenoble,
+#             France
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NON INFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import numpy as np
+
+
+def channel_blocks(nchannels, blockChannels):
+    return [slice(start, min(start + blockChannels, nchannels)) for start in range(0, nchannels, blockChannels)]
+
+
+def randomized_svd(sinograms, rank, oversampling=10, powerIterations=2, blockChannels=256, seed=0):
+    """
+    Truncated SVD of a (y, rot, channels) sinogram cube along its channels, by randomized range finding with power
+    iterations. The cube is only read by blocks of blockChannels channels, so it may be a memory map or an h5py
+    dataset. Returns the (y, rot, rank) component sinograms (left singular vectors scaled by the singular values),
+    the singular values and the (rank, channels) spectra, so that sinograms ~ components @ spectra.
+    """
+    shape = sinograms.shape
+    npixels = shape[0] * shape[1]
+    blocks = channel_blocks(shape[2], blockChannels)
+
+    def block(channels):
+        return np.asarray(sinograms[:, :, channels], dtype=np.float64).reshape(npixels, -1)
+
+    def times(matrix):
+        """ sinograms @ matrix """
+        return sum(block(channels) @ matrix[channels] for channels in blocks)
+
+    def transposed_times(matrix):
+        """ sinograms.T @ matrix """
+        return np.concatenate([block(channels).T @ matrix for channels in blocks])
+
+    rank = min(rank, npixels, shape[2])
+    sketch = min(rank + oversampling, npixels, shape[2])
+    rng = np.random.default_rng(seed)
+    basis = np.linalg.qr(times(rng.standard_normal((shape[2], sketch))))[0]
+    for i in range(powerIterations):
+        basis = np.linalg.qr(times(np.linalg.qr(transposed_times(basis))[0]))[0]
+    u, singular, spectra = np.linalg.svd(transposed_times(basis).T, full_matrices=False)
+    components = (basis @ u[:, :rank]) * singular[:rank]
+    return components.reshape(shape[0], shape[1], rank).astype(np.float32), singular[:rank], spectra[:rank]
+
+
+def energy(sinograms, blockChannels=256):
+    """ squared Frobenius norm of a (y, rot, channels) cube, read by blocks of channels """
+    return sum(np.sum(np.square(sinograms[:, :, channels], dtype=np.float64))
+               for channels in channel_blocks(sinograms.shape[2], blockChannels))
+
+
+def expand(images, spectra, channels=slice(None)):
+    """
+    Expands (components, ...) images with their (components, channels) spectra into (channels, ...) images for the
+    selected channels.
+    """
+    return np.tensordot(np.asarray(spectra)[:, channels].T, images, axes=1)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#    Project: PyXRDCT
+#             https://github.com/poautran/PyXRDCT
+#
+#    Copyright (C) 2022-2023 European Synchrotron Radiation Facility, Grenoble,
+#             France
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NON INFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+
+def stable(value):
+    """
+    Converts cache key parameters to plain Python values whose repr does not depend on the numpy version: numpy
+    scalars to floats or ints, containers to tuples and arrays to their dtype, shape and a hash of their bytes.
+    """
+    if isinstance(value, np.ndarray):
+        array = np.ascontiguousarray(value)
+        return 'array', array.dtype.str, array.shape, hashlib.sha1(array.tobytes()).hexdigest()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, dict):
+        return tuple(sorted((str(key), stable(item)) for key, item in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(stable(item) for item in value)
+    return value
+
+
+class StageCache:
+    """
+    Disk cache of the intermediate arrays of a pipeline, one .npy file per entry, read back memory-mapped.
+
+    Each entry is keyed by its stage name and a hash of its inputs and parameters. Passing the key of the upstream
+    stage as an input chains the stages, so changing a parameter only recomputes the stages downstream of it.
+    The least recently used entries are evicted once the cache grows over maxBytes, and maxBytes=0 disables the
+    cache: stages are computed every time and nothing is written.
+    """
+
+    def __init__(self, path, maxBytes=20 * 1024 ** 3):
+        self.path = path
+        self.maxBytes = maxBytes
+
+    def key(self, stage, *params):
+        return '%s-%s' % (stage, hashlib.sha1(repr(stable(params)).encode()).hexdigest())
+
+    def entry(self, key):
+        return os.path.join(self.path, key + '.npy')
+
+    def get(self, key):
+        """
+        Returns the cached array of key, or None.
+        """
+        try:
+            array = np.load(self.entry(key), mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        os.utime(self.entry(key))
+        return array
+
+    def put(self, key, array):
+        """
+        Stores array under key and evicts the least recently used entries. Arrays larger than the cache are
+        returned without being stored.
+        """
+        array = np.asarray(array)
+        if array.nbytes > self.maxBytes:
+            return array
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmpPath = tempfile.mkstemp(prefix='.tmp_', suffix='.npy', dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmpPath, self.entry(key))
+        self.evict()
+        return np.load(self.entry(key), mmap_mode='r')
+
+    def cached(self, key, compute):
+        """
+        Returns the cached array of key, computing and storing it if missing.
+        """
+        if not self.maxBytes:
+            return compute()
+        array = self.get(key)
+        if array is None:
+            array = self.put(key, compute())
+        else:
+            print('[INFO] Using cached %s' % key.split('-')[0])
+        return array
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.npy') and not name.startswith('.tmp_'):
+                stat = os.stat(os.path.join(self.path, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for mtime, size, name in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            os.remove(os.path.join(self.path, name))
+            total -= size
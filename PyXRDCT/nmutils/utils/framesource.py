@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#    Project: PyXRDCT
+#             https://github.com/poautran/PyXRDCT
+#
+#    Copyright (C) 2022-2023 European Synchrotron Radiation Facility, Grenoble,
+#             France
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NON INFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import concurrent.futures
+import os
+import queue
+import threading
+
+import h5py
+import numpy as np
+
+try:
+    import bitshuffle
+except ImportError:
+    bitshuffle = None
+
+BSHUF_FILTER = 32008
+BSHUF_LZ4 = 2
+
+
+def frame_layout(h5File, address):
+    """
+    Returns the file path, dataset address and chunk shape of the frames at address of an open h5py file. A virtual
+    dataset mapping a whole single source, like the detector data of a Bliss scan in its lima file, resolves to that
+    source so that its chunks can be read directly. Virtual datasets of several sources are kept, with the chunks of
+    their first source.
+    """
+    dataset = h5File[address]
+    if not dataset.is_virtual:
+        return h5File.filename, address, dataset.chunks
+    sources = dataset.virtual_sources()
+    first = sources[0]
+    path = h5File.filename if first.file_name == '.' else os.path.join(os.path.dirname(h5File.filename),
+                                                                      first.file_name)
+    with h5py.File(path, 'r') as h5Source:
+        sourceDataset = h5Source[first.dset_name]
+        chunks = sourceDataset.chunks
+        sameShape = sourceDataset.shape == dataset.shape
+    # one source of the same shape covering the whole virtual dataset is mapped frame to frame
+    if len(sources) == 1 and sameShape and first.vspace.get_select_npoints() == int(np.prod(dataset.shape)):
+        return path, first.dset_name, chunks
+    return h5File.filename, address, chunks
+
+
+class FrameSource:
+    """
+    Prefetching block reader for detector frames stored in HDF5.
+
+    Bitshuffle/LZ4 (Bliss default) or uncompressed chunks spanning whole frames are read with direct chunk reads
+    and decompressed in a thread pool into a ring of reusable block buffers, while the consumer works on the
+    previous block. Any other layout falls back to h5py reads in the prefetch thread.
+    """
+
+    def __init__(self, h5Path, address, blockSize=32, prefetch=2, threads=4):
+        self.h5File = h5py.File(h5Path, 'r')
+        self.dataset = self.h5File[address]
+        self.shape = self.dataset.shape
+        self.dtype = self.dataset.dtype
+        self.chunks = self.dataset.chunks
+        self.filter = self.chunkFilter()
+        if self.filter is not None:
+            # blocks are made of whole chunks
+            blockSize = max(1, blockSize // self.chunks[0]) * self.chunks[0]
+        self.blockSize = min(blockSize, self.shape[0])
+        self.ring = [np.empty((self.blockSize,) + tuple(self.shape[1:]), dtype=self.dtype) for _ in
+                     range(prefetch + 1)]
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+
+    def chunkFilter(self):
+        """
+        Returns the decompression mode usable with direct chunk reads, or None.
+        """
+        if self.chunks is None or self.dataset.is_virtual or tuple(self.chunks[1:]) != tuple(self.shape[1:]):
+            return None
+        filters = self.dataset._filters
+        if not filters:
+            return 'raw'
+        if bitshuffle is not None and list(filters.keys()) == [str(BSHUF_FILTER)]:
+            options = filters[str(BSHUF_FILTER)]
+            if len(options) > 4 and options[4] == BSHUF_LZ4:
+                return 'bitshuffle'
+        return None
+
+    def decompress(self, raw, filterMask, out, first, nframes):
+        """
+        Decodes one raw chunk into out[0:nframes], skipping the first frames of the chunk.
+        """
+        if filterMask:
+            self.dataset.read_direct(out, np.s_[first:first + nframes], np.s_[:nframes])
+            return
+        if self.filter == 'raw':
+            chunk = np.frombuffer(raw, dtype=self.dtype).reshape(self.chunks)
+        else:
+            buffer = np.frombuffer(raw, dtype=np.uint8)
+            blockElements = int.from_bytes(raw[8:12], 'big') // self.dtype.itemsize
+            chunk = bitshuffle.decompress_lz4(buffer[12:], self.chunks, self.dtype, blockElements)
+        offset = first % self.chunks[0]
+        out[:nframes] = chunk[offset:offset + nframes]
+
+    def submit(self, slot, start, stop):
+        """
+        Reads the raw chunks covering frames start:stop and queues their decompression into slot.
+        """
+        if self.filter is None:
+            self.dataset.read_direct(slot, np.s_[start:stop], np.s_[:stop - start])
+            return []
+        futures = []
+        frame = start
+        while frame < stop:
+            chunkStart = frame - frame % self.chunks[0]
+            nframes = min(chunkStart + self.chunks[0], stop) - frame
+            filterMask, raw = self.dataset.id.read_direct_chunk((chunkStart,) + (0,) * (len(self.shape) - 1))
+            futures.append(self.pool.submit(self.decompress, raw, filterMask, slot[frame - start:], frame, nframes))
+            frame += nframes
+        return futures
+
+    def read(self, start, stop, out=None):
+        """
+        Reads frames start:stop synchronously, into out if provided.
+        """
+        if out is None:
+            out = np.empty((stop - start,) + tuple(self.shape[1:]), dtype=self.dtype)
+        for future in self.submit(out, start, stop):
+            future.result()
+        return out
+
+    def blocks(self, start=0, stop=None):
+        """
+        Yields (first frame, frames) blocks. A block buffer is recycled once the consumer asks for the next one.
+        """
+        stop = self.shape[0] if stop is None else min(stop, self.shape[0])
+        free = queue.Queue()
+        ready = queue.Queue()
+        for slot in self.ring:
+            free.put(slot)
+
+        def producer():
+            try:
+                for first in range(start, stop, self.blockSize):
+                    slot = free.get()
+                    if slot is None:
+                        return
+                    last = min(first + self.blockSize, stop)
+                    ready.put((first, last, slot, self.submit(slot, first, last)))
+            except Exception as exception:
+                ready.put(exception)
+            ready.put(None)
+
+        thread = threading.Thread(target=producer, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = ready.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                first, last, slot, futures = item
+                for future in futures:
+                    future.result()
+                yield first, slot[:last - first]
+                free.put(slot)
+        finally:
+            free.put(None)
+            thread.join()
+
+    def close(self):
+        self.pool.shutdown()
+        self.h5File.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -27,10 +27,16 @@
 
 import os
 
-import h5py
 import numpy as np
 
 import PyXRDCT.nmutils.utils.saveh5 as saveh5
+from PyXRDCT.nmutils.utils.scanindex import scan_index
+
+Y_MOTORS = ['dty', 'diffty', 'diffy']
+ROT_MOTORS = ['rot', 'diffrz', 'shrz']
+XRD_DETECTORS = ['eiger', 'frelon3']
+XRF_DETECTORS = ['mca_det0']
+MONITORS = ['fpico6', 'fpico4']
 
 
 class Input:
@@ -61,6 +67,15 @@ class Input:
         saveh5.makeSaveDirs(self.savePath)
         print('[INFO] Data will be saved in %s!' % self.savePath)
 
+    def index(self):
+        """
+        Returns the metadata index of all scans, built in one pass over the master file and kept next to savePath.
+        """
+        if not hasattr(self, 'scanIndex'):
+            self.scanIndex = scan_index(self.dataPath, os.path.join(self.savePath, self.dataset + '_scan_index.h5'),
+                                        Y_MOTORS, ROT_MOTORS)
+        return self.scanIndex
+
     def getScanGeometry(self):
         """
         Reads scan Geometry from ESRF Bliss h5 file.
@@ -69,20 +84,18 @@ class Input:
         scansInput = []
         yMotor = self.yMotor()
         rotMotor = self.rotMotor()
-        with h5py.File(self.dataPath, 'r') as h5In:
-            scans = np.array(list(h5In.keys()))
-            scanCheckTitle = h5In[scans[0]]['title'][()].decode("utf-8").split(' ')
-            for scan in scans:
-                if scan.split('.')[1] == scanKey[0] and (
-                        h5In[scan]['title'][()].decode("utf-8").split(' ')[0:2] == scanCheckTitle[0:2]):
-                    scansInput.append(int(scan.split('.')[0]))
+        index = self.index()
+        scans = np.array(list(index.keys()))
+        scanCheckTitle = index[scans[0]]['title'].split(' ')
+        for scan in scans:
+            if scan.split('.')[1] == scanKey[0] and (index[scan]['title'].split(' ')[0:2] == scanCheckTitle[0:2]):
+                scansInput.append(int(scan.split('.')[0]))
         scansInput = sorted(scansInput)
         for scan in scansInput:
             self.scans.append('%s.%s' % (scan, scanKey[0]))
-        with h5py.File(self.dataPath, 'r') as h5In:
-            for scan in self.scans:
-                self.y.append(h5In['%s/instrument/positioners/%s' % (scan, yMotor)][()])
-                self.rot.append(h5In['%s/measurement/%s' % (scan, rotMotor)][()])
+        for scan in self.scans:
+            self.y.append(index[scan]['positioners'][yMotor])
+            self.rot.append(index[scan]['motors'][rotMotor])
         self.y = np.array(self.y)
         self.rot = np.array(self.rot)
         if len(np.array(self.y).shape) == 1:
@@ -96,11 +109,9 @@ class Input:
         """
         Finds y motor from provided list.
         """
-        yMotors = ['dty', 'diffty', 'diffy']
-        with h5py.File(self.dataPath, 'r') as h5In:
-            for motor in yMotors:
-                if motor in list(h5In['1.1/instrument/positioners'].keys()):
-                    self.yMotor = motor
+        for motor in Y_MOTORS:
+            if motor in self.index()['1.1']['positioners']:
+                self.yMotor = motor
         print('[INFO] Y motor detected: %s' % self.yMotor)
         return self.yMotor
 
@@ -108,11 +119,9 @@ class Input:
         """
         Finds y motor from provided list.
         """
-        rotMotors = ['rot', 'diffrz', 'shrz']
-        with h5py.File(self.dataPath, 'r') as h5In:
-            for motor in rotMotors:
-                if motor in list(h5In['1.1/measurement'].keys()):
-                    self.rotMotor = motor
+        for motor in ROT_MOTORS:
+            if motor in self.index()['1.1']['measurement']:
+                self.rotMotor = motor
         print('[INFO] Rot motor detected: %s' % self.rotMotor)
         return self.rotMotor
 
@@ -120,12 +129,10 @@ class Input:
         """
         Finds XRD detector.
         """
-        xrdDetectors = ['eiger', 'frelon3']
-        with h5py.File(self.dataPath, 'r') as h5In:
-            for detector in xrdDetectors:
-                if detector in list(h5In['1.1/measurement'].keys()):
-                    self.xrddetector = detector
-                    print('[INFO] XRD detector: %s' % self.xrddetector)
+        for detector in XRD_DETECTORS:
+            if detector in self.index()['1.1']['measurement']:
+                self.xrddetector = detector
+                print('[INFO] XRD detector: %s' % self.xrddetector)
 
     def getXrdDetectorMask(self):
         """
@@ -144,25 +151,21 @@ class Input:
         """
         Finds XRF detector and channels.
         """
-        xrfDetectors = ['mca_det0']
-        with h5py.File(self.dataPath, 'r') as h5In:
-            for detector in xrfDetectors:
-                if detector in list(h5In['1.1/measurement'].keys()):
-                    self.xrfdetector = detector
-                    print('[INFO] XRF detector: %s' % self.xrfdetector)
-                    self.channels = h5In['1.1/measurement'][detector][:].shape[1]
-                    print('[INFO] XRF detector channels detected: %s' % self.channels)
+        for detector in XRF_DETECTORS:
+            if detector in self.index()['1.1']['measurement']:
+                self.xrfdetector = detector
+                print('[INFO] XRF detector: %s' % self.xrfdetector)
+                self.channels = self.index()['1.1']['measurement'][detector]['shape'][1]
+                print('[INFO] XRF detector channels detected: %s' % self.channels)
 
     def getBeamMonitor(self):
         """
         Finds XRF detector and channels.
         """
-        monitors = ['fpico6', 'fpico4']
-        with h5py.File(self.dataPath, 'r') as h5In:
-            for monitor in monitors:
-                if monitor in list(h5In['1.1/measurement'].keys()):
-                    self.beamMonitor = monitor
-                    print('[INFO] Beam Monitor: %s' % self.beamMonitor)
+        for monitor in MONITORS:
+            if monitor in self.index()['1.1']['measurement']:
+                self.beamMonitor = monitor
+                print('[INFO] Beam Monitor: %s' % self.beamMonitor)
 
     def loadData(self):
         """
@@ -173,6 +176,5 @@ class Input:
         self.getXrdDetectorMask()
         self.getBeamMonitor()
         self.getScanGeometry()
-        with h5py.File(self.dataPath, 'r') as h5In:
-            for scan in self.scans:
-                self.dataUrls.append(h5In.get('%s/measurement/%s' % (scan, self.xrddetector), getlink=True).path)
+        for scan in self.scans:
+            self.dataUrls.append(self.index()[scan]['measurement'][self.xrddetector]['link'])
@@ -28,7 +28,6 @@
 import os
 
 import h5py
-from pyFAI.io.nexus import save_NXmonpd
 
 
 def makeSaveDirs(savePath):
@@ -41,6 +40,7 @@ def saveIntegrateH5(savePath, result, title):
     """
     Saves result in a h5 NeXus file with relpath being filled with the rest of the save path (including extension)
     """
+    from pyFAI.io.nexus import save_NXmonpd
     makeSaveDirs(os.path.dirname(savePath))
     save_NXmonpd(savePath, result, title=title, entry='entry', instrument='ID11 beamline', source_name='ESRF',
                  source_type='Synchrotron', source_probe='x-ray',
@@ -60,3 +60,57 @@ def saveReconstructedH5(savePath, result, metadata=None, xAxis='X'):
         dsetMetadata = h5Out.create_dataset('entry_0000/%s' % xAxis, [len(metadata)], dtype='f')
         dsetMetadata[...] = metadata
     print('[INFO] %s saved!' % savePath)
+
+
+def saveCompressedH5(savePath, components, spectra, singular, metadata=None, xAxis='X'):
+    """
+    Saves a spectrally compressed reconstruction as its component images, their spectra and singular values with
+    metadata as h5
+    """
+    if metadata is None:
+        metadata = []
+    makeSaveDirs(os.path.dirname(savePath))
+    with h5py.File(savePath, 'w') as h5Out:
+        h5Out.create_dataset('entry_0000/components', data=components, dtype='f')
+        h5Out.create_dataset('entry_0000/spectra', data=spectra, dtype='f')
+        h5Out.create_dataset('entry_0000/singular_values', data=singular, dtype='f8')
+        dsetMetadata = h5Out.create_dataset('entry_0000/%s' % xAxis, [len(metadata)], dtype='f')
+        dsetMetadata[...] = metadata
+    print('[INFO] %s saved!' % savePath)
+
+
+def createReconstructedH5(savePath, shape, metadata=None, xAxis='X'):
+    """
+    Preallocates the reconstruction data and its metadata as h5, chunked by slice so blocks can be written as
+    they are reconstructed.
+    """
+    if metadata is None:
+        metadata = []
+    makeSaveDirs(os.path.dirname(savePath))
+    with h5py.File(savePath, 'w') as h5Out:
+        h5Out.create_dataset('entry_0000/data', shape, dtype='f', chunks=(1,) + tuple(shape[1:]))
+        dsetMetadata = h5Out.create_dataset('entry_0000/%s' % xAxis, [len(metadata)], dtype='f')
+        dsetMetadata[...] = metadata
+
+
+def createIntegratedCube(savePath, shape, scans):
+    """
+    Preallocates the (y, rot, radial) integrated cube, chunked for both sinogram reads of a few radial bins and
+    pattern reads of a few frames. An existing cube of the same shape and scans is kept for resuming, any other one
+    is replaced. Returns whether the cube was created.
+    """
+    if os.path.exists(savePath):
+        with h5py.File(savePath, 'r') as h5In:
+            same = (h5In['entry/results/data'].shape == tuple(shape) and
+                    [scan.decode() for scan in h5In['entry/results/scans'][:]] == list(scans))
+        if same:
+            return False
+        os.remove(savePath)
+    makeSaveDirs(os.path.dirname(savePath))
+    chunks = (min(shape[0], 16), min(shape[1], 64), min(shape[2], 32))
+    with h5py.File(savePath, 'w') as h5Out:
+        h5Out.create_dataset('entry/results/data', shape, dtype='f', chunks=chunks, compression='lzf', shuffle=True)
+        h5Out.create_dataset('entry/results/polar_angle', [shape[2]], dtype='f8')
+        h5Out.create_dataset('entry/results/scans', data=[scan.encode() for scan in scans])
+    print('[INFO] %s created!' % savePath)
+    return True
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#    Project: PyXRDCT
+#             https://github.com/poautran/PyXRDCT
+#
+#    Copyright (C) 2022-2023 European Synchrotron Radiation Facility, Grenoble,
+#             France
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NON INFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+
+import h5py
+
+# bumped when the layout of the saved index changes, so older index files are rebuilt
+INDEX_VERSION = 2
+
+
+def build_scan_index(dataPath, yMotors, rotMotors):
+    """
+    Reads the metadata of every scan of a Bliss master file in one traversal: title, y positioners, shape, dtype
+    and soft link target of each measurement entry, and rotation motor arrays. Shapes of entries stored in
+    external files are left out so detector files are never opened.
+    """
+    index = {}
+    with h5py.File(dataPath, 'r') as h5In:
+        for scan in h5In.keys():
+            group = h5In[scan]
+            info = {'title': group['title'][()].decode("utf-8") if 'title' in group else '', 'positioners': {},
+                    'measurement': {}, 'motors': {}}
+            if 'instrument/positioners' in group:
+                for motor in yMotors:
+                    if motor in group['instrument/positioners']:
+                        info['positioners'][motor] = group['instrument/positioners'][motor][()]
+            if 'measurement' in group:
+                for key in group['measurement'].keys():
+                    link = group['measurement'].get(key, getlink=True)
+                    path = link.path if isinstance(link, h5py.SoftLink) else '/%s/measurement/%s' % (scan, key)
+                    entry = {'link': link.path if isinstance(link, h5py.SoftLink) else None, 'shape': None,
+                             'dtype': None}
+                    if not isinstance(h5In.get(path, getlink=True), h5py.ExternalLink) and path in h5In:
+                        entry['shape'] = h5In[path].shape
+                        entry['dtype'] = h5In[path].dtype.str
+                    info['measurement'][key] = entry
+                for motor in rotMotors:
+                    if motor in info['measurement'] and info['measurement'][motor]['shape'] is not None:
+                        info['motors'][motor] = group['measurement'][motor][()]
+            index[scan] = info
+    return index
+
+
+def save_scan_index(indexPath, index, dataPath):
+    """
+    Saves the scan index as h5, stamped with the size and modification time of the master file.
+    """
+    stat = os.stat(dataPath)
+    with h5py.File(indexPath + '.partial', 'w') as h5Out:
+        h5Out.attrs['size'] = stat.st_size
+        h5Out.attrs['mtime'] = stat.st_mtime_ns
+        h5Out.attrs['version'] = INDEX_VERSION
+        for scan, info in index.items():
+            group = h5Out.create_group(scan)
+            group.attrs['title'] = info['title']
+            positioners = group.create_group('positioners')
+            # per-frame positioner arrays of fscans can exceed the 64 kB limit of attributes
+            for motor, value in info['positioners'].items():
+                positioners.create_dataset(motor, data=value)
+            for key, entry in info['measurement'].items():
+                measurement = group.create_group('measurement/%s' % key)
+                if entry['link'] is not None:
+                    measurement.attrs['link'] = entry['link']
+                if entry['shape'] is not None:
+                    measurement.attrs['shape'] = entry['shape']
+                    measurement.attrs['dtype'] = entry['dtype']
+            for motor, values in info['motors'].items():
+                group.create_dataset('motors/%s' % motor, data=values)
+    os.replace(indexPath + '.partial', indexPath)
+
+
+def read_scan_index(indexPath):
+    index = {}
+    with h5py.File(indexPath, 'r') as h5In:
+        for scan, group in h5In.items():
+            index[scan] = {'title': group.attrs['title'],
+                           'positioners': {motor: value[()] for motor, value in group['positioners'].items()},
+                           'measurement': {}, 'motors': {}}
+            for key, measurement in group.get('measurement', {}).items():
+                index[scan]['measurement'][key] = {
+                    'link': measurement.attrs.get('link'),
+                    'shape': tuple(int(n) for n in measurement.attrs['shape']) if 'shape' in measurement.attrs else None,
+                    'dtype': measurement.attrs.get('dtype')}
+            for motor, values in group.get('motors', {}).items():
+                index[scan]['motors'][motor] = values[()]
+    return index
+
+
+def scan_index(dataPath, indexPath, yMotors, rotMotors):
+    """
+    Returns the scan index of the master file, read from indexPath if it was built from the file as it is now,
+    rebuilt and saved otherwise.
+    """
+    stat = os.stat(dataPath)
+    if os.path.exists(indexPath):
+        with h5py.File(indexPath, 'r') as h5In:
+            current = (h5In.attrs.get('size') == stat.st_size and h5In.attrs.get('mtime') == stat.st_mtime_ns and
+                       h5In.attrs.get('version') == INDEX_VERSION)
+        if current:
+            return read_scan_index(indexPath)
+    index = build_scan_index(dataPath, yMotors, rotMotors)
+    save_scan_index(indexPath, index, dataPath)
+    print('[INFO] Scan index saved in %s' % indexPath)
+    return index
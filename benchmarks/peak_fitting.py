@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#    Project: PyXRDCT
+#             https://github.com/poautran/PyXRDCT
+#
+#    Copyright (C) 2022-2023 European Synchrotron Radiation Facility, Grenoble,
+#             France
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NON INFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""
+Per-voxel peak fitting of reconstructed XRD-CT patterns: scipy curve_fit voxel by voxel against the batched
+Levenberg-Marquardt, from the same initial guess, on synthetic Gaussian peaks on a linear background.
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PyXRDCT.core.fitting import initial_guess, levenberg_marquardt, LN2
+
+
+def gaussian(x, area, center, fwhm, background, slope):
+    return area * np.sqrt(LN2 / np.pi) / fwhm * np.exp(-LN2 * ((x - center) / fwhm) ** 2) + background + slope * x
+
+
+def patterns(nvoxels, x, seed=0):
+    rng = np.random.default_rng(seed)
+    true = np.column_stack([rng.uniform(1, 5, nvoxels), rng.uniform(5.3, 5.7, nvoxels),
+                            rng.uniform(0.05, 0.2, nvoxels), rng.uniform(0, 2, nvoxels), rng.uniform(-0.2, 0.2, nvoxels)])
+    return gaussian(x, *true.T[:, :, None]) + rng.normal(0, 0.05, (nvoxels, len(x)))
+
+
+def main(nvoxels=4096, npoints=80):
+    from scipy.optimize import curve_fit
+    x = np.linspace(5, 6, npoints)
+    y = patterns(nvoxels, x)
+    start = time.perf_counter()
+    params = levenberg_marquardt(x, y)[0]
+    batchedTime = time.perf_counter() - start
+    guess = initial_guess(x, y, 'gaussian')[0]
+    nreference = min(nvoxels, 512)
+    start = time.perf_counter()
+    reference = np.array([curve_fit(gaussian, x, y[i], p0=guess[i])[0] for i in range(nreference)])
+    referenceTime = (time.perf_counter() - start) * nvoxels / nreference
+    print('%d voxels of %d points: curve_fit %8.1f voxels/s, batched %8.1f voxels/s, max center difference %.1e' % (
+        nvoxels, npoints, nvoxels / referenceTime, nvoxels / batchedTime,
+        np.abs(reference[:, 1] - params[:nreference, 1]).max()))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 4096)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#    Project: PyXRDCT
+#             https://github.com/poautran/PyXRDCT
+#
+#    Copyright (C) 2022-2023 European Synchrotron Radiation Facility, Grenoble,
+#             France
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NON INFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""
+Throughput of the s3dxrd pixel selection: the fused select_top kernel against the former select + top_pixels pair,
+including the per-frame buffer allocations and copies the former implementation made.
+"""
+
+import os
+import sys
+import time
+
+import numba
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PyXRDCT.core import s3dxrd
+from PyXRDCT.core.s3dxrd import CUT, howmany, thresholds
+
+
+@numba.njit(cache=True)
+def select(img, msk, row, col, val):
+    cut = CUT
+    # Choose the pixels that are > cut and put into sparse arrays
+    k = 0
+    for s in range(img.shape[0]):
+        for f in range(img.shape[1]):
+            if img[s, f] > cut:
+                if msk[s, f]:  # skip masked
+                    continue
+                row[k] = s
+                col[k] = f
+                val[k] = img[s, f]
+                k += 1
+    return k
+
+
+@numba.njit(cache=True)
+def top_pixels(nnz, row, col, val, howmany):
+    # quick return if there are already few enough pixels
+    if nnz <= howmany:
+        return nnz
+    # histogram of how many pixels are above each threshold
+    h = np.zeros(len(thresholds), dtype=np.uint32)
+    for k in range(nnz):
+        for i, t in enumerate(thresholds):
+            if val[k] > t:
+                h[i] += 1
+            else:
+                break
+    # choose the one to use. This is the first that is lower than howmany
+    tcut = thresholds[-1]
+    for n, t in zip(h, thresholds):
+        if n < howmany:
+            tcut = t
+            break
+    # now we filter the pixels
+    n = 0
+    for k in range(nnz):
+        if val[k] > tcut:
+            row[n] = row[k]
+            col[n] = col[k]
+            val[n] = val[k]
+            n += 1
+            if n >= howmany:
+                break
+    return n
+
+
+def former(frm, msk):
+    row = np.empty(msk.size, np.uint16)
+    col = np.empty(msk.size, np.uint16)
+    val = np.empty(msk.size, frm.dtype)
+    nnz = select(frm, msk, row, col, val)
+    if nnz > howmany:
+        nnz = top_pixels(nnz, row, col, val, howmany)
+    return row[:nnz].copy(), col[:nnz].copy(), val[:nnz].copy()
+
+
+def fused(frm, msk):
+    hist, row, col, val = s3dxrd.scratch(frm)
+    nnz = s3dxrd.select_top(frm, msk, howmany, hist, row, col, val)
+    return row[:nnz], col[:nnz], val[:nnz]
+
+
+def frames(nframes, shape=(2162, 2068), seed=0):
+    """ Eiger-sized frames with a Poisson background, a few spots and, every fourth frame, diffuse scattering """
+    rng = np.random.default_rng(seed)
+    frms = rng.poisson(1.0, (nframes,) + shape).astype(np.uint32)
+    for i in range(nframes):
+        for k in range(20):
+            y, x = rng.integers(5, shape[0] - 5), rng.integers(5, shape[1] - 5)
+            frms[i, y - 3:y + 3, x - 3:x + 3] += np.uint32(rng.integers(10, 2000))
+        if i % 4 == 0:
+            frms[i, :shape[0] // 8] += rng.poisson(12.0, (shape[0] // 8, shape[1])).astype(np.uint32)
+    return frms
+
+
+def throughput(function, frms, msk):
+    function(frms[0], msk)
+    start = time.perf_counter()
+    for frm in frms:
+        function(frm, msk)
+    return len(frms) / (time.perf_counter() - start)
+
+
+def main(nframes=16):
+    frms = frames(nframes)
+    msk = np.zeros(frms.shape[1:], np.int32)
+    msk[:, :50] = 1
+    for frm in frms:
+        for a, b in zip(former(frm, msk), fused(frm, msk)):
+            assert np.array_equal(a, b)
+    print('%d numba threads, %d frames of %dx%d' % ((numba.get_num_threads(),) + frms.shape))
+    print('%-24s %8.1f frames/s' % ('select + top_pixels', throughput(former, frms, msk)))
+    print('%-24s %8.1f frames/s' % ('select_top', throughput(fused, frms, msk)))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 16)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#    Project: PyXRDCT
+#             https://github.com/poautran/PyXRDCT
+#
+#    Copyright (C) 2022-2023 European Synchrotron Radiation Facility, Grenoble,
+#             France
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NON INFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+"""
+1D integration of spotty frames through the batched engine: dense blocks of frames against the sparse path that
+only reads the matrix columns of the stored pixels, on the same frames and for several fractions of stored pixels.
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PyXRDCT.core.engine import IntegrationEngine
+
+
+def engine(shape=(1024, 1024), nbpt_rad=1000):
+    import pyFAI.detectors
+    from pyFAI.azimuthalIntegrator import AzimuthalIntegrator
+    detector = pyFAI.detectors.Detector(pixel1=75e-6, pixel2=75e-6, max_shape=shape)
+    ai = AzimuthalIntegrator(dist=0.1, poni1=shape[0] * 37.5e-6, poni2=shape[1] * 37.5e-6, detector=detector,
+                             wavelength=3e-11)
+    return IntegrationEngine.build(ai, shape, nbpt_rad, '2th_deg', polarization_factor=0.99)
+
+
+def spotty_frames(nframes, shape, fraction, seed=0):
+    """ frames whose nonzero pixels, a fraction of the detector, are grouped in 5x5 spots """
+    rng = np.random.default_rng(seed)
+    frames = np.zeros((nframes,) + shape, np.float32)
+    nspots = max(1, int(fraction * shape[0] * shape[1] / 25))
+    for frame in frames:
+        for y, x in zip(rng.integers(0, shape[0] - 5, nspots), rng.integers(0, shape[1] - 5, nspots)):
+            frame[y:y + 5, x:x + 5] = rng.random() * 1000
+    return frames
+
+
+def timed(function, repeats=3):
+    result = function()
+    start = time.perf_counter()
+    for i in range(repeats):
+        function()
+    return result, (time.perf_counter() - start) / repeats
+
+
+def main(nframes=32, shape=(1024, 1024)):
+    start = time.perf_counter()
+    integrationEngine = engine(shape)
+    print('engine built in %.1fs, %d frames of %dx%d' % ((time.perf_counter() - start, nframes) + shape))
+    integrationEngine.integrate_sparse(np.zeros(1, np.int64), np.zeros(1, np.int64), np.ones(1), 1)
+    for fraction in (1e-4, 1e-3, 1e-2, 1e-1):
+        frames = spotty_frames(nframes, shape, fraction)
+        frame, row, col = np.nonzero(frames)
+        index = row * shape[1] + col
+        dense, denseTime = timed(lambda: integrationEngine.integrate(frames))
+        sparse, sparseTime = timed(lambda: integrationEngine.integrate_sparse(index, frame, frames[frame, row, col],
+                                                                              nframes))
+        print('%6.2f%% pixels: dense %8.1f frames/s, sparse %8.1f frames/s, max relative difference %.1e' % (
+            100 * len(index) / frames.size, nframes / denseTime, nframes / sparseTime,
+            np.abs(sparse - dense).max() / np.abs(dense).max()))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 32)
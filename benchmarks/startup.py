@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#    Project: PyXRDCT
+#             https://github.com/poautran/PyXRDCT
+#
+#    Copyright (C) 2022-2023 European Synchrotron Radiation Facility, Grenoble,
+#             France
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NON INFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+"""
+Import time of PyXRDCT modules and spin-up time of numba kernels and worker pools, each measured in a fresh
+interpreter, minus the start-up time of an empty interpreter. numba kernels are timed twice: the first run may
+compile them, the second one should load them from the cache.
+
+    python benchmarks/startup.py [repeats]
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BENCHMARKS = [
+    ('import numba', 'import numba'),
+    ('import pyFAI', 'import pyFAI.azimuthalIntegrator'),
+    ('import matplotlib.pyplot', 'import matplotlib.pyplot'),
+    ('import readh5', 'import PyXRDCT.nmutils.utils.readh5'),
+    ('import integrate', 'import PyXRDCT.core.integrate'),
+    ('import reconstruction', 'import PyXRDCT.core.reconstruction'),
+    ('import s3dxrd', 'import PyXRDCT.core.s3dxrd'),
+    ('fbp first call', 'import numpy as np\nfrom PyXRDCT.core.fbp import fbp\n'
+                       'fbp(np.ones((64, 90, 4), np.float32), np.linspace(0, 180, 90))'),
+    ('fbp first call (cached)', 'import numpy as np\nfrom PyXRDCT.core.fbp import fbp\n'
+                                'fbp(np.ones((64, 90, 4), np.float32), np.linspace(0, 180, 90))'),
+    ('s3dxrd warmup', 'import numpy as np\nfrom PyXRDCT.core.s3dxrd import warmup\n'
+                      'warmup(np.dtype(np.uint32), np.zeros((1, 1), np.int32))'),
+    ('s3dxrd warmup (cached)', 'import numpy as np\nfrom PyXRDCT.core.s3dxrd import warmup\n'
+                               'warmup(np.dtype(np.uint32), np.zeros((1, 1), np.int32))'),
+    ('pool of 4 spin-up', 'import multiprocessing\nimport PyXRDCT.core.integrate\n'
+                          'with multiprocessing.Pool(4) as pool:\n    pool.map(abs, range(4))'),
+]
+
+
+def run(code):
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], check=True, env=env, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def main(repeats=3):
+    interpreter = min(run('pass') for i in range(repeats))
+    print('%-28s %8.3fs' % ('empty interpreter', interpreter))
+    for name, code in BENCHMARKS:
+        if name.endswith('(cached)'):
+            timing = run(code)
+        else:
+            timing = min(run(code) for i in range(1 if 'first call' in name or 'warmup' in name else repeats))
+        print('%-28s %8.3fs' % (name, timing - interpreter))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3)
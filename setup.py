@@ -28,6 +28,7 @@ setuptools.setup(
         'matplotlib',
         'hdf5plugin',
         'ImageD11',
+        'numba',
         'scikit-image'
     ]
 )